@@ -27,24 +27,1630 @@ The library version matches closely the API version it handles: browshot.py 1.0.
 browshot.py can handle most the API updates within the same major version, e.g. browshot.py 1.0.0 should be compatible with the API 1.1 or 1.2. """
 
 
+import os
+import re
+import sys
+import mmap
+import hashlib
 import urllib
-from urllib2 import Request, urlopen, URLError, HTTPError
+import copy
+import time
+import zlib
+import struct
+import random
+import heapq
+import bisect
+import itertools
+import inspect
+import tempfile
+import threading
+import Queue
+import argparse
+import multiprocessing
+import collections
+import sqlite3
+import urlparse
+import SocketServer
+import BaseHTTPServer
 import simplejson
 import requests
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Use the fastest JSON decoder installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        json_loads = ujson.loads
+    except ImportError:
+        json_loads = simplejson.loads
+
+
+class BrowshotError(Exception):
+    def __init__(self, message='', code=0):
+        """ Error raised by the library when a request cannot be completed.
+
+        Arguments:
+            message: description of the error
+            code: HTTP status code returned by the API server, 0 if the error did not come from the server.
+        """
+        Exception.__init__(self, message)
+        self.code = code
+
+
+def _save_chunks(chunks, file, expected_size=None):
+    """ Write chunks to file, a path or a file object, and return the number of bytes written.
+
+    A path is written to a temporary file in the same directory, which is renamed once all the chunks have been written: the file is either complete or absent. BrowshotError is raised if expected_size is set and does not match the number of bytes received.
+    """
+    if hasattr(file, 'write'):
+        size = 0
+        for chunk in chunks:
+            file.write(chunk)
+            size += len(chunk)
+
+        if expected_size is not None and size != expected_size:
+            raise BrowshotError('Expected %d bytes, received %d bytes' % (expected_size, size))
+        return size
+
+    directory, name = os.path.split(os.path.abspath(file))
+    descriptor, temporary = tempfile.mkstemp(prefix='.' + name + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as handle:
+            size = _save_chunks(chunks, handle, expected_size)
+
+        if size > 0:
+            try:
+                os.rename(temporary, file)
+            except OSError:
+                # Windows does not replace existing files
+                os.remove(file)
+                os.rename(temporary, file)
+        else:
+            os.remove(temporary)
+
+        return size
+    except:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+class BrowshotFuture(object):
+    def __init__(self):
+        """ Result of a request running in the background. Call result() to wait for the reply. """
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """ Return True if the request has completed, successfully or not. """
+        return self._done
+
+    def result(self, timeout=None):
+        """ Wait for the request to complete and return its reply. The exception raised by the request, if any, is raised again.
+
+            Arguments:
+                timeout: maximum number of seconds to wait. Wait forever by default. BrowshotError is raised if the request has not completed in time.
+        """
+        self.wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """ Wait for the request to complete and return the exception it raised, or None. """
+        self.wait(timeout)
+        return self._exception
+
+    def wait(self, timeout=None):
+        """ Wait for the request to complete. BrowshotError is raised if it has not completed after timeout seconds. """
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise BrowshotError('Request not completed after %s seconds' % timeout)
+
+    def add_done_callback(self, callback):
+        """ Call callback(future) once the request has completed. The callback is called immediately if the request has already completed. """
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        self._complete(result, None)
+
+    def set_exception(self, exception):
+        self._complete(None, exception)
+
+    def _complete(self, result, exception):
+        with self._condition:
+            if self._done:
+                return
+            self._result = result
+            self._exception = exception
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = []
+            self._condition.notify_all()
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                pass
+
+
+class BrowshotWorkerPool(object):
+    def __init__(self, workers=10):
+        """ Fixed number of threads running functions in the background.
+
+        Arguments:
+            workers: number of threads, i.e. the maximum number of functions running at the same time. 10 by default.
+        """
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.threads = []
+
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name='browshot-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, function, *args, **kwargs):
+        """ Queue function(*args, **kwargs) and return a BrowshotFuture for its result. """
+        future = BrowshotFuture()
+        self.queue.put((future, function, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        """ Stop the threads once all the queued functions have run. """
+        for thread in self.threads:
+            self.queue.put(None)
+
+        if wait:
+            for thread in self.threads:
+                if thread is not threading.current_thread():
+                    thread.join()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+
+            future, function, args, kwargs = task
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception, e:
+                future.set_exception(e)
+
+
+def _multipart(name, filename, chunks, boundary, compress=False):
+    """ Return an iterator over the body of a multipart/form-data request with a single file, optionally gzip-compressed. """
+    def body():
+        yield '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: text/plain\r\n\r\n' % (boundary, name, filename)
+        for chunk in chunks:
+            yield chunk
+        yield '\r\n--%s--\r\n' % boundary
+
+    if not compress:
+        return body()
+
+    def compressed():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in body():
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    return compressed()
+
+
+def _url_chunks(urls, chunk_size=65536):
+    """ Return an iterator over the content of a list of URLs, one URL per line, grouped in chunks of about chunk_size bytes. urls can be a path, a file object or any iterable of URLs. """
+    if isinstance(urls, basestring):
+        with open(urls, 'rb') as handle:
+            for chunk in _url_chunks(handle, chunk_size):
+                yield chunk
+        return
+
+    if hasattr(urls, 'read'):
+        while True:
+            chunk = urls.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    lines = []
+    size = 0
+    for url in urls:
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        line = url.rstrip('\r\n') + '\n'
+        lines.append(line)
+        size += len(line)
+
+        if size >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+            size = 0
+
+    if len(lines) > 0:
+        yield ''.join(lines)
+
+
+def _json_object_items(chunks):
+    """ Return an iterator over the (key, value) pairs of a JSON object, decoding each value as soon as it has been received. Only one value is held in memory at a time. """
+    decoder = simplejson.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ['']
+
+    def more():
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        buffer[0] += chunk
+        return True
+
+    def skip(index):
+        while True:
+            while index < len(buffer[0]) and buffer[0][index] in ' \t\r\n':
+                index += 1
+            if index < len(buffer[0]) or not more():
+                return index
+
+    def expect(index, characters):
+        index = skip(index)
+        if index >= len(buffer[0]) or not buffer[0][index] in characters:
+            raise BrowshotError('Invalid JSON reply')
+        return index + 1, buffer[0][index]
+
+    def decode(index):
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer[0], index)
+            except ValueError:
+                if not more():
+                    raise BrowshotError('Invalid JSON reply')
+                continue
+
+            # A value is only complete if it was followed by another character when it was decoded: a number could be truncated otherwise
+            if end < len(buffer[0]) or not more():
+                return value, end
+
+    index, character = expect(0, '{[')
+    if character == '[':
+        # Empty lists are sent instead of empty objects
+        expect(index, ']')
+        return
+
+    index = skip(index)
+    if buffer[0][index:index + 1] == '}':
+        return
+
+    while True:
+        key, index = decode(skip(index))
+        index, character = expect(index, ':')
+        value, index = decode(skip(index))
+        yield key, value
+
+        index, character = expect(index, ',}')
+        buffer[0] = buffer[0][index:]
+        index = 0
+        if character == '}':
+            return
+
+
+_timings = threading.local()
+
+
+def _add_timing(name, value):
+    setattr(_timings, name, getattr(_timings, name, 0) + value)
+
+
+class _TimedConnection(object):
+    def connect(self):
+        start = time.time()
+        try:
+            super(_TimedConnection, self).connect()
+        finally:
+            _add_timing('connect', time.time() - start)
+
+
+class _TimedPool(object):
+    def _get_conn(self, timeout=None):
+        start = time.time()
+        try:
+            return super(_TimedPool, self)._get_conn(timeout)
+        finally:
+            _add_timing('pool_wait', time.time() - start)
+
+
+class _TimedHTTPConnection(_TimedConnection, requests.packages.urllib3.connectionpool.HTTPConnectionPool.ConnectionCls):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnection, requests.packages.urllib3.connectionpool.HTTPSConnectionPool.ConnectionCls):
+    pass
+
+
+class _TimedHTTPConnectionPool(_TimedPool, requests.packages.urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(_TimedPool, requests.packages.urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class BrowshotTransport(object):
+    def __init__(self, pool_size=10, timeout=60, keep_alive=True, block=True):
+        """ HTTP transport used by BrowshotClient for all the API requests. Connections are kept alive and shared by all the threads through a connection pool, so the TCP and TLS handshakes are done only once per connection.
+
+        Arguments:
+            pool_size: maximum number of connections kept open to the API server. 10 by default.
+            timeout: timeout in seconds to connect and to read the response. Use a tuple (connect, read) to set them separately. 60 seconds by default.
+            keep_alive: Set to False to close the connection after each request. True by default.
+            block: Set to False to open extra connections when all the connections of the pool are in use, instead of waiting for one to be released. True by default.
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=block)
+        # Measure the time spent waiting for a connection and opening connections
+        adapter.poolmanager.pool_classes_by_scheme = {'http': _TimedHTTPConnectionPool, 'https': _TimedHTTPSConnectionPool}
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def get(self, url, stream=False, headers=None):
+        """ Send a GET request and return the requests.Response object. With stream=True, the body is not read until it is consumed, and the connection goes back to the pool once the response is closed. """
+        return self.session.get(url, stream=stream, headers=headers, timeout=self.timeout)
+
+    def post(self, url, data=None, files=None, headers=None):
+        """ Send a POST request and return the requests.Response object. """
+        return self.session.post(url, data=data, files=files, headers=headers, timeout=self.timeout)
+
+    def timings(self):
+        """ Return the seconds spent by the current thread waiting for a connection of the pool and opening new connections (DNS, TCP and TLS) since the last call, as {'pool_wait': <seconds>, 'connect': <seconds>}. """
+        timings = {'pool_wait': getattr(_timings, 'pool_wait', 0), 'connect': getattr(_timings, 'connect', 0)}
+        _timings.pool_wait = 0
+        _timings.connect = 0
+        return timings
+
+    def close(self):
+        """ Close all the connections of the pool. """
+        self.session.close()
+
+
+class BrowshotMetadataCache(object):
+    def __init__(self, ttl=None, max_entries=1000):
+        """ Cache for the replies that rarely change: instance_list, instance_info, browser_list and browser_info. The cache can be shared by several clients and threads.
+
+        Arguments:
+            ttl: dictionary of action => number of seconds a reply is kept. Only these actions are cached. By default, instances are kept 60 seconds (their load changes) and browsers 1 hour.
+            max_entries: maximum number of replies kept. The least recently used replies are removed first. 1000 by default.
+        """
+        if ttl is None:
+            ttl = {'instance/list': 60, 'instance/info': 60, 'browser/list': 3600, 'browser/info': 3600}
+
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def handles(self, action=''):
+        """ Return True if replies for this action are cached. """
+        return action in self.ttl
+
+    def get(self, action='', parameters={}):
+        """ Return a copy of the cached reply, or None if there is no valid reply in the cache. """
+        key = self._key(action, parameters)
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+
+            self._entries[key] = entry
+            self.hits += 1
+
+        return copy.deepcopy(entry[1])
+
+    def set(self, action='', parameters={}, reply=None):
+        """ Store a reply in the cache. """
+        key = self._key(action, parameters)
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl.get(action, 0), copy.deepcopy(reply))
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, action=None, id=None):
+        """ Remove replies from the cache: all of them by default, only the replies for an action, or only the replies for an instance or browser ID. """
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if action is not None and key[0] != action:
+                    continue
+                if id is not None and not ('id', str(id)) in key[1]:
+                    continue
+                del self._entries[key]
+
+    def stats(self):
+        """ Return {'hits': <hits>, 'misses': <misses>, 'entries': <number of replies cached>}. """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+    def _key(self, action, parameters):
+        return (action, tuple(sorted((str(key), str(value)) for key, value in parameters.items())))
+
+
+class BrowshotScreenshotCache(object):
+    def __init__(self, directory, max_size=1024 * 1024 * 1024):
+        """ Local disk cache for the images returned by simple and screenshot_thumbnail. The cache can be shared by several clients, threads and processes.
+
+        Images are stored once per content, whatever the number of requests returning them. Thumbnails of a screenshot never change and are kept until they are evicted. Images from simple are kept as long as the cache=X parameter of the request (24 hours by default), then revalidated with a conditional request if the server sent an ETag or Last-Modified header.
+
+        Arguments:
+            directory (Required): local directory to store the images
+            max_size: maximum size of the images stored, in bytes. The least recently used images are removed first. 1GB by default.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._objects = collections.OrderedDict()
+        self._size = 0
+
+        for name in ('objects', 'keys'):
+            if not os.path.isdir(os.path.join(directory, name)):
+                os.makedirs(os.path.join(directory, name))
+
+        objects = []
+        for name in os.listdir(os.path.join(directory, 'objects')):
+            if name.endswith('.tmp'):
+                continue
+            stat = os.stat(os.path.join(directory, 'objects', name))
+            objects.append((stat.st_mtime, name, stat.st_size))
+
+        for mtime, name, size in sorted(objects):
+            self._objects[name] = size
+            self._size += size
+
+    def lookup(self, key='', max_age=None):
+        """ Return the cache entry for a request, or None if the image is not in the cache. If max_age is set, entries older than max_age seconds are returned with 'stale' set to True. """
+        entry = None
+        try:
+            with open(self._key_path(key), 'rb') as handle:
+                entry = simplejson.loads(handle.read())
+        except (IOError, ValueError), e:
+            pass
+
+        with self._lock:
+            if entry is None or not entry['object'] in self._objects:
+                self.misses += 1
+                return None
+
+            self._objects[entry['object']] = self._objects.pop(entry['object'])
+
+        entry['stale'] = max_age is not None and entry['time'] + max_age <= time.time()
+        with self._lock:
+            if entry['stale']:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if not entry['stale']:
+            self._touch(entry['object'])
+
+        return entry
+
+    def store(self, key='', chunks=[], headers={}):
+        """ Store an image and return its cache entry, or None if the image is empty. """
+        digest = hashlib.sha1()
+        descriptor, temporary = tempfile.mkstemp(suffix='.tmp', dir=os.path.join(self.directory, 'objects'))
+        try:
+            with os.fdopen(descriptor, 'wb') as handle:
+                size = 0
+                for chunk in chunks:
+                    digest.update(chunk)
+                    handle.write(chunk)
+                    size += len(chunk)
+
+            if size == 0:
+                os.remove(temporary)
+                return None
+
+            name = digest.hexdigest()
+            if os.path.exists(self._object_path(name)):
+                os.remove(temporary)
+                self._touch(name)
+            else:
+                os.rename(temporary, self._object_path(name))
+        except:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+        with self._lock:
+            self._size -= self._objects.pop(name, 0)
+            self._objects[name] = size
+            self._size += size
+
+        entry = {'object': name, 'size': size, 'time': time.time(), 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+        self._write_key(key, entry)
+        self._evict()
+
+        entry['stale'] = False
+        return entry
+
+    def refresh(self, key='', entry={}):
+        """ Mark an entry as valid again after it has been revalidated by the server, and return it. """
+        entry = dict(entry, time=time.time(), stale=False)
+        self._write_key(key, entry)
+        self._touch(entry['object'])
+        return entry
+
+    def read(self, entry={}):
+        """ Return the content of the image of an entry. The file is memory-mapped instead of being read through a buffer. """
+        with open(self._object_path(entry['object']), 'rb') as handle:
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return mapped[:]
+            finally:
+                mapped.close()
+
+    def iter(self, entry={}, chunk_size=65536):
+        """ Return an iterator over the content of the image of an entry. """
+        with open(self._object_path(entry['object']), 'rb') as handle:
+            while True:
+                chunk = handle.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def clear(self):
+        """ Remove all the images from the cache. """
+        with self._lock:
+            for name in self._objects.keys():
+                self._remove(name)
+            self._objects.clear()
+            self._size = 0
+
+    def stats(self):
+        """ Return {'hits': <hits>, 'misses': <misses>, 'entries': <number of images>, 'size': <size of the images>}. """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._objects), 'size': self._size}
+
+    def _evict(self):
+        with self._lock:
+            while self._size > self.max_size and len(self._objects) > 1:
+                name, size = self._objects.popitem(last=False)
+                self._size -= size
+                self._remove(name)
+
+    def _remove(self, name):
+        # Keys pointing to a removed image are ignored by lookup()
+        try:
+            os.remove(self._object_path(name))
+        except OSError:
+            pass
+
+    def _touch(self, name):
+        try:
+            os.utime(self._object_path(name), None)
+        except OSError:
+            pass
+
+    def _write_key(self, key, entry):
+        path = self._key_path(key)
+        entry = dict((name, value) for name, value in entry.items() if name != 'stale')
+        _save_chunks([simplejson.dumps(entry)], path)
+
+    def _key_path(self, key):
+        return os.path.join(self.directory, 'keys', hashlib.sha1(key).hexdigest())
+
+    def _object_path(self, name):
+        return os.path.join(self.directory, 'objects', name)
+
+
+class BrowshotRateLimiter(object):
+    def __init__(self, rate=10, burst=None, path=None):
+        """ Limit the number of requests sent per second, using a token bucket. The limiter can be shared by several clients and threads, and by several processes through a state file.
+
+        Arguments:
+            rate: number of requests allowed per second, on average. 10 by default.
+            burst: maximum number of requests sent at once after a pause. Same as rate by default.
+            path: file used to share the limit between processes on the same host. The limit is kept in memory by default. Requires fcntl (not available on Windows).
+        """
+        if path is not None and fcntl is None:
+            raise BrowshotError('A shared rate limit requires fcntl')
+
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.path = path
+
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """ Wait until tokens requests can be sent. """
+        while True:
+            wait = self._take(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def _take(self, tokens):
+        with self._lock:
+            if self.path is None:
+                self._tokens, self._updated, wait = self._refill(self._tokens, self._updated, tokens)
+                return wait
+
+            with open(self.path, 'a+') as handle:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+                try:
+                    handle.seek(0)
+                    try:
+                        available, updated = [float(value) for value in handle.read().split()]
+                    except ValueError:
+                        available, updated = self.burst, time.time()
+
+                    available, updated, wait = self._refill(available, updated, tokens)
+                    handle.seek(0)
+                    handle.truncate()
+                    handle.write('%f %f' % (available, updated))
+                    handle.flush()
+                finally:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+
+            return wait
+
+    def _refill(self, available, updated, tokens):
+        now = time.time()
+        available = min(self.burst, available + (now - updated) * self.rate)
+        if available >= tokens:
+            return (available - tokens, now, 0)
+        return (available, now, (tokens - available) / self.rate)
+
+
+class BrowshotCreditGovernor(object):
+    def __init__(self, client, minimum=0, refresh=60, poll_interval=5, max_wait=None, default_cost=1):
+        """ Keep track of the credits left on the account, and hold screenshot_create and screenshot_multiple until enough credits are available instead of sending requests that would fail.
+
+            client.credit_governor = BrowshotCreditGovernor(client)
+
+        The balance is read from account_info and the cost of each instance from instance_list. The credits of the requests in progress are reserved, and released if the request fails.
+
+        Arguments:
+            client: BrowshotClient object used to get the balance and the instances.
+            minimum: number of credits to keep on the account. 0 by default.
+            refresh: number of seconds between two account_info. 60 seconds by default.
+            poll_interval: number of seconds between two account_info while waiting for credits. 5 seconds by default.
+            max_wait: maximum number of seconds to wait for credits, after which BrowshotError is raised. Wait forever by default.
+            default_cost: cost of a screenshot when the instance is not known. 1 by default.
+        """
+        self.client = client
+        self.minimum = minimum
+        self.refresh = refresh
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.default_cost = default_cost
+
+        self.balance = None
+        self.reserved = 0
+        self._costs = {}
+        self._updated = 0
+        self._condition = threading.Condition()
+
+    def cost(self, action='', parameters={}):
+        """ Return the number of credits a request may use. """
+        if not self._costs:
+            instances = self.client.instance_list()
+            with self._condition:
+                for type in ('free', 'shared', 'private'):
+                    for instance in instances.get(type, []):
+                        self._costs[str(instance['id'])] = float(instance.get('screenshot_cost', self.default_cost) or 0)
+
+        if action == 'screenshot/multiple':
+            urls = len(parameters.get('urls', [])) or 1
+            instances = parameters.get('instances', [])
+            if len(instances) == 0:
+                return urls * self.default_cost
+            return urls * sum(self._costs.get(str(instance), self.default_cost) for instance in instances)
+
+        if 'instance_id' in parameters:
+            return self._costs.get(str(parameters['instance_id']), self.default_cost)
+        return self.default_cost
+
+    def reserve(self, credits=1):
+        """ Wait until credits are available, and reserve them. """
+        deadline = None
+        if self.max_wait is not None:
+            deadline = time.time() + self.max_wait
+
+        while True:
+            if self.balance is None or self._updated + self.refresh <= time.time():
+                self.update()
+
+            with self._condition:
+                if self.balance - self.reserved - credits >= self.minimum:
+                    self.reserved += credits
+                    return
+
+            if deadline is not None and time.time() >= deadline:
+                raise BrowshotError('Not enough credits left: %s' % self.balance)
+
+            wait = self.poll_interval
+            if deadline is not None:
+                wait = min(wait, max(deadline - time.time(), 0))
+
+            with self._condition:
+                self._condition.wait(wait)
+            self._updated = 0
+
+    def release(self, credits=1, used=False):
+        """ Release credits reserved with reserve(). If used is True, they are deducted from the balance until the next account_info. """
+        with self._condition:
+            self.reserved -= credits
+            if used and self.balance is not None:
+                self.balance -= credits
+            self._condition.notify_all()
+
+    def update(self):
+        """ Read the balance from account_info. """
+        account = self.client.account_info({})
+        if 'error' in account:
+            raise BrowshotError(account['error'])
+
+        with self._condition:
+            self.balance = float(account.get('balance', 0))
+            self._updated = time.time()
+            self._condition.notify_all()
+
+
+class BrowshotCircuitBreaker(object):
+    def __init__(self, failures=10, reset_timeout=30):
+        """ Stop sending requests for a while when the API server keeps failing: after <failures> consecutive server errors or network errors, requests fail immediately with BrowshotError for <reset_timeout> seconds. Then a single request is let through: if it succeeds, requests are sent again normally.
+
+        Arguments:
+            failures: number of consecutive failures after which requests are stopped. 10 by default.
+            reset_timeout: number of seconds requests are stopped. 30 seconds by default.
+        """
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+
+        self.state = 'closed'
+        self._count = 0
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def before(self):
+        """ Raise BrowshotError if requests are stopped. """
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' and self._opened + self.reset_timeout <= time.time():
+                self.state = 'half-open'
+                return
+
+        raise BrowshotError('The API server is not available, requests are stopped for %d seconds' % self.reset_timeout, 503)
+
+    def success(self):
+        with self._lock:
+            self.state = 'closed'
+            self._count = 0
+
+    def failure(self):
+        with self._lock:
+            self._count += 1
+            if self.state == 'half-open' or self._count >= self.failures:
+                self.state = 'open'
+                self._opened = time.time()
+
+
+class BrowshotRetryPolicy(object):
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30, deadline=None, charged=('simple', 'screenshot/create', 'screenshot/multiple', 'batch/create', 'crawl/create'), circuit_breaker=None):
+        """ Send requests again after network errors, timeouts and server errors (HTTP 5xx and 429), waiting a random time between 0 and backoff * 2^attempt seconds between two attempts. The Retry-After header is honored.
+
+        Requests that use credits are only sent again if the previous attempt could not reach the server, so that a screenshot is never paid twice.
+
+        Arguments:
+            retries: maximum number of times a request is sent again. 3 by default.
+            backoff: base time to wait between two attempts, in seconds. 0.5 second by default.
+            max_backoff: maximum time to wait between two attempts, in seconds. 30 seconds by default.
+            deadline: maximum number of seconds spent on a request, all attempts included. No limit by default.
+            charged: actions that use credits.
+            circuit_breaker: BrowshotCircuitBreaker object, shared by all the requests using this policy. A BrowshotCircuitBreaker with the default settings is created by default. Set to False to disable.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.charged = charged
+
+        if circuit_breaker is None:
+            circuit_breaker = BrowshotCircuitBreaker()
+        self.circuit_breaker = circuit_breaker or None
+
+    def call(self, action='', send=None):
+        """ Call send(), which sends a request and returns a requests.Response object, as many times as needed. """
+        deadline = None
+        if self.deadline is not None:
+            deadline = time.time() + self.deadline
+
+        attempt = 0
+        while True:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.before()
+
+            retry_after = None
+            try:
+                response = send()
+            except requests.RequestException, e:
+                self._failure()
+                if attempt >= self.retries or not self.retryable(action, e):
+                    raise
+            else:
+                if response.status_code < 500 and response.status_code != 429:
+                    self._success()
+                    return response
+
+                if response.status_code >= 500:
+                    self._failure()
+                if attempt >= self.retries or (action in self.charged and response.status_code != 429):
+                    return response
+
+                retry_after = response.headers.get('Retry-After')
+                response.close()
+
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            if deadline is not None and time.time() + delay >= deadline:
+                raise BrowshotError('Request to %s not completed before the deadline' % action, 504)
+
+            time.sleep(delay)
+            attempt += 1
+
+    def retryable(self, action='', error=None):
+        """ Return True if a request that raised error can be sent again. """
+        if not action in self.charged:
+            return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+        # The request may have been processed, unless the connection could not even be opened
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        if isinstance(error, requests.ConnectionError) and len(error.args) > 0:
+            reason = getattr(error.args[0], 'reason', error.args[0])
+            return isinstance(reason, (requests.packages.urllib3.exceptions.NewConnectionError, requests.packages.urllib3.exceptions.ConnectTimeoutError))
+        return False
+
+    def _success(self):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.success()
+
+    def _failure(self):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.failure()
+
+
+def _redact(url):
+    """ Return url without the API key. """
+    return re.sub(r'([?&]key=)[^&]*', r'\1***', url)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class BrowshotMetrics(object):
+    PHASES = ('pool_wait', 'connect', 'ttfb', 'body', 'total')
+
+    def __init__(self, buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60), callbacks=None):
+        """ Counters and latency histograms of the API requests, by action. A BrowshotMetrics object can be shared by several clients and threads:
+
+            metrics = BrowshotMetrics()
+            client = BrowshotClient(key, metrics=metrics)
+            ...
+            print metrics.prometheus()
+
+        For each request, the time is split in pool_wait (waiting for a connection of the pool), connect (opening a new connection, DNS, TCP and TLS included), ttfb (until the response headers are received, the two previous phases included), body (reading the response) and total. Retries, bytes sent and received, new connections and cache hits are counted as well.
+
+        Arguments:
+            buckets: upper bounds of the latency histograms, in seconds.
+            callbacks: functions called with a dictionary for each request once it is complete, in the format of an OpenTelemetry span: {'name': 'GET screenshot/info', 'start_time': <time>, 'end_time': <time>, 'status': 'ok' or 'error', 'attributes': {...}}. The API key is removed from the URL.
+        """
+        self.buckets = tuple(buckets)
+        self.callbacks = list(callbacks or [])
+        self._actions = {}
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def record(self, span):
+        """ Record a request. Called by BrowshotClient with a dictionary of the start and end times, the phases, the status, the retries and the bytes transferred. """
+        total = span['end'] - span['start']
+        ttfb = span.get('ttfb', total)
+        phases = {'pool_wait': span.get('pool_wait', 0), 'connect': span.get('connect', 0), 'ttfb': ttfb, 'body': max(total - ttfb, 0), 'total': total}
+        status = str(span.get('status', 'error'))
+
+        with self._lock:
+            action = self._actions.get(span['action'])
+            if action is None:
+                action = {'requests': {}, 'retries': 0, 'sent': 0, 'received': 0, 'connections': 0,
+                          'latency': dict((phase, [0] * (len(self.buckets) + 1) + [0.0]) for phase in self.PHASES)}
+                self._actions[span['action']] = action
+
+            action['requests'][status] = action['requests'].get(status, 0) + 1
+            action['retries'] += span.get('retries', 0)
+            action['sent'] += span.get('sent', 0)
+            action['received'] += span.get('received', 0)
+            if phases['connect'] > 0:
+                action['connections'] += 1
+
+            for phase, value in phases.items():
+                histogram = action['latency'][phase]
+                histogram[bisect.bisect_left(self.buckets, value)] += 1
+                histogram[-1] += value
+
+        if self.callbacks:
+            attributes = dict((key, value) for key, value in span.items() if not key in ('start', 'end'))
+            attributes.update(phases)
+            exported = {'name': '%s %s' % (span['method'], span['action']), 'start_time': span['start'], 'end_time': span['end'],
+                        'status': 'error' if 'error' in span or span['status'] >= 400 else 'ok', 'attributes': attributes}
+            for callback in self.callbacks:
+                callback(exported)
+
+    def cache(self, name='', hit=True):
+        """ Count a cache lookup.
+
+            Arguments:
+                name (Required): name of the cache, e.g. 'metadata'
+                hit: True if the reply was found in the cache
+        """
+        with self._lock:
+            counts = self._caches.setdefault(name, {'hits': 0, 'misses': 0})
+            counts['hits' if hit else 'misses'] += 1
+
+    def snapshot(self):
+        """ Return the counters as a dictionary:
+                {'actions': {<action>: {'requests': {<status>: <count>}, 'retries': <count>, 'sent': <bytes>, 'received': <bytes>, 'connections': <count>,
+                                        'latency': {<phase>: {'count': <count>, 'sum': <seconds>, 'buckets': [(<upper bound>, <cumulative count>), ...]}}}},
+                 'caches': {<name>: {'hits': <count>, 'misses': <count>}}}
+        """
+        with self._lock:
+            actions = {}
+            for name, action in self._actions.items():
+                latency = {}
+                for phase, histogram in action['latency'].items():
+                    counts = []
+                    for count in histogram[:-1]:
+                        counts.append(count + (counts[-1] if counts else 0))
+                    latency[phase] = {'count': counts[-1], 'sum': histogram[-1], 'buckets': zip(self.buckets + (float('inf'),), counts)}
+                actions[name] = dict(action, requests=dict(action['requests']), latency=latency)
+            return {'actions': actions, 'caches': copy.deepcopy(self._caches)}
+
+    def prometheus(self, prefix='browshot'):
+        """ Return the counters in the Prometheus text format. """
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, type, help, samples):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, type))
+            for suffix, labels, value in samples:
+                lines.append('%s_%s%s{%s} %s' % (prefix, name, suffix, ','.join('%s="%s"' % (key, _label(label)) for key, label in labels), repr(value) if isinstance(value, float) else value))
+
+        actions = sorted(snapshot['actions'].items())
+        metric('requests_total', 'counter', 'API requests by action and HTTP status.',
+               [('', [('action', name), ('status', status)], count) for name, action in actions for status, count in sorted(action['requests'].items())])
+        metric('retries_total', 'counter', 'Requests sent again after a failure.', [('', [('action', name)], action['retries']) for name, action in actions])
+        metric('bytes_total', 'counter', 'Bytes sent and received.',
+               [('', [('action', name), ('direction', direction)], action[direction]) for name, action in actions for direction in ('sent', 'received')])
+        metric('connections_total', 'counter', 'New connections opened.', [('', [('action', name)], action['connections']) for name, action in actions])
+
+        samples = []
+        for name, action in actions:
+            for phase in self.PHASES:
+                histogram = action['latency'][phase]
+                for bound, count in histogram['buckets']:
+                    samples.append(('_bucket', [('action', name), ('phase', phase), ('le', '+Inf' if bound == float('inf') else repr(float(bound)))], count))
+                samples.append(('_sum', [('action', name), ('phase', phase)], float(histogram['sum'])))
+                samples.append(('_count', [('action', name), ('phase', phase)], histogram['count']))
+        metric('request_duration_seconds', 'histogram', 'Duration of the API requests by phase.', samples)
+
+        metric('cache_requests_total', 'counter', 'Cache lookups.',
+               [('', [('cache', name), ('result', result)], counts[key]) for name, counts in sorted(snapshot['caches'].items()) for result, key in (('hit', 'hits'), ('miss', 'misses'))])
+
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """ Set all the counters back to 0. """
+        with self._lock:
+            self._actions = {}
+            self._caches = {}
+
+
+class _MeteredResponse(object):
+    """ Streamed requests.Response recorded in BrowshotMetrics once its body has been read or it is closed. """
+    def __init__(self, response, span, metrics):
+        self._response = response
+        self._span = span
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for chunk in self._response.iter_content(chunk_size, decode_unicode):
+            if self._span is not None:
+                self._span['received'] += len(chunk)
+            yield chunk
+        self._done()
+
+    def close(self):
+        self._response.close()
+        self._done()
+
+    def _done(self):
+        span = self._span
+        if span is not None:
+            self._span = None
+            span['end'] = time.time()
+            self._metrics.record(span)
+
+
+def _counted(chunks, span):
+    for chunk in chunks:
+        span['sent'] += len(chunk)
+        yield chunk
+
+
+class BrowshotResult(object):
+    """ Reply of the API, returned instead of a dictionary by a BrowshotClient created with typed=True.
+
+    Attributes are read from the reply when they are accessed, and converted to the type documented by the API: screenshot.width is an integer, instance.browser a BrowshotBrowser object, etc. AttributeError is raised if the reply does not contain the attribute.
+
+    The reply itself is still available as a read-only dictionary: result['width'], result.get('width'), 'error' in result, dict(result).
+    """
+    __slots__ = ('_data',)
+    _types = {}
+
+    def __init__(self, data=None):
+        self._data = data or {}
+
+    def __getattr__(self, name):
+        try:
+            value = self._data[name]
+        except KeyError:
+            raise AttributeError(name)
+
+        convert = self._types.get(name)
+        if convert is None or value is None or value == '':
+            return value
+        return convert(value)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, BrowshotResult):
+            other = other._data
+        return self._data == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._data)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def keys(self):
+        return self._data.keys()
+
+    def items(self):
+        return self._data.items()
+
+    def to_dict(self):
+        """ Return the reply as a dictionary. """
+        return self._data
+
+
+def _flag(value):
+    return bool(int(value))
+
+
+class BrowshotBrowser(BrowshotResult):
+    """ Browser returned by browser_info, browser_list and instance_info. """
+    __slots__ = ()
+    _types = {'id': int, 'javascript': _flag, 'flash': _flag, 'mobile': _flag}
+
+
+class BrowshotInstance(BrowshotResult):
+    """ Instance returned by instance_info and instance_list. """
+    __slots__ = ()
+    _types = {'id': int, 'width': int, 'height': int, 'load': float, 'screenshot_cost': int, 'active': _flag, 'browser': BrowshotBrowser}
+
+
+class BrowshotScreenshot(BrowshotResult):
+    """ Screenshot returned by screenshot_create, screenshot_info, screenshot_list, screenshot_search, screenshot_multiple and crawl_info. """
+    __slots__ = ()
+    _types = {'id': int, 'instance_id': int, 'width': int, 'height': int, 'priority': int, 'response_code': int, 'cost': int, 'scale': float,
+              'delay': int, 'flash_delay': int, 'started': int, 'finished': int, 'load': int, 'request_time': int, 'processing': int}
+
+
+class BrowshotBatch(BrowshotResult):
+    """ Batch returned by batch_create and batch_info. """
+    __slots__ = ()
+    _types = {'id': int, 'count': int, 'processed': int, 'failed': int, 'started': int, 'finished': int}
+
+
+def _screenshots(screenshots):
+    return [BrowshotScreenshot(screenshot) for screenshot in screenshots]
+
+
+class BrowshotCrawl(BrowshotResult):
+    """ Crawl returned by crawl_create and crawl_info. """
+    __slots__ = ()
+    _types = {'id': int, 'max': int, 'count': int, 'processed': int, 'failed': int, 'started': int, 'finished': int, 'screenshots': _screenshots}
+
+
+_RESULT_CLASSES = {
+    'browser/info':         BrowshotBrowser,
+    'instance/info':        BrowshotInstance,
+    'screenshot/create':    BrowshotScreenshot,
+    'screenshot/info':      BrowshotScreenshot,
+    'batch/create':         BrowshotBatch,
+    'batch/info':           BrowshotBatch,
+    'crawl/create':         BrowshotCrawl,
+    'crawl/info':           BrowshotCrawl,
+}
+
+_RESULT_LISTS = {
+    'browser/list':         BrowshotBrowser,
+    'screenshot/list':      BrowshotScreenshot,
+    'screenshot/search':    BrowshotScreenshot,
+    'screenshot/multiple':  BrowshotScreenshot,
+}
+
+
+def _typed(action, reply):
+    """ Wrap the reply of action in the matching BrowshotResult classes. Replies of other actions, and errors returned instead of a list, are left unchanged. """
+    if not isinstance(reply, dict):
+        return reply
+
+    if action in _RESULT_CLASSES:
+        return _RESULT_CLASSES[action](reply)
+
+    if 'error' in reply:
+        return reply
+
+    if action in _RESULT_LISTS:
+        type = _RESULT_LISTS[action]
+        return dict((key, type(value)) for key, value in reply.items())
+
+    if action == 'instance/list':
+        return dict((key, [BrowshotInstance(instance) for instance in value]) for key, value in reply.items())
+
+    return reply
+
+
+class BrowshotRequestBuilder(object):
+    def __init__(self, base='https://api.browshot.com/api/v1/', key='', max_url_length=4000):
+        """ Build the URLs of the API requests. The base URL and the API key are encoded once, and the parameters of each request are encoded in a single pass.
+
+        Arguments:
+            base: Base URL for all API requests.
+            key: API key.
+            max_url_length: JSON requests with a longer URL, e.g. screenshot_multiple with hundreds of URLs, are sent as a POST request with the parameters in the body. 4000 characters by default.
+        """
+        self.base = base
+        self.key = key
+        self.max_url_length = max_url_length
+        self._key = '?key=' + urllib.quote_plus(key)
+
+    def query(self, parameters={}):
+        """ Return the parameters encoded as a query string, without the API key. """
+        quote = urllib.quote_plus
+        fields = []
+        for key, value in parameters.items():
+            if key == 'urls':
+                fields.extend(['url=' + quote(str(uri)) for uri in value])
+            elif key == 'instances':
+                fields.extend(['instance_id=' + quote(str(instance_id)) for instance_id in value])
+            else:
+                fields.append(quote(key) + '=' + quote(str(value)))
+        return '&'.join(fields)
+
+    def request_key(self, action='', parameters={}):
+        """ Return a string identifying a request, whatever the order of the parameters. """
+        return action + '?' + '&'.join(sorted(self.query(parameters).split('&')))
+
+    def url(self, action='', parameters={}):
+        """ Return the URL of a GET request. """
+        query = self.query(parameters)
+        if query == '':
+            return ''.join((self.base, action, self._key))
+        return ''.join((self.base, action, self._key, '&', query))
+
+    def request(self, action='', parameters={}):
+        """ Return (method, url, body) for a request. body is None for GET requests, and the parameters encoded as a form for POST requests. """
+        query = self.query(parameters)
+        url = ''.join((self.base, action, self._key))
+        if len(url) + len(query) + 1 <= self.max_url_length:
+            if query == '':
+                return ('GET', url, None)
+            return ('GET', ''.join((url, '&', query)), None)
+        return ('POST', url, query)
+
+
+class BrowshotPreparedRequest(object):
+    def __init__(self, client, action='', parameters={}):
+        """ Request sent many times with only a different screenshot, batch or crawl ID. The other parameters are encoded once:
+
+            info = client.prepare('screenshot/info', {'details': 3})
+            for id in ids:
+                screenshot = info.reply(id)
+
+        The metadata cache, the screenshot cache and the credit governor are not used.
+
+        Arguments:
+            client: BrowshotClient object used to send the requests.
+            action (Required): API action, e.g. 'screenshot/info'
+            parameters: parameters shared by all the requests.
+        """
+        self.client = client
+        self.action = action
+        self._url = client.make_url(action, dict((key, value) for key, value in parameters.items() if key != 'id'))
+
+    def make_url(self, id=0):
+        """ Return the URL of the request for id. """
+        return self._url + '&id=' + urllib.quote_plus(str(id))
+
+    def reply_string(self, id=0):
+        """ Return the content returned by the request for id. """
+        return self.client.send_request('GET', self.make_url(id)).content
+
+    def reply(self, id=0):
+        """ Return the decoded JSON reply of the request for id. """
+        return self.client.return_typed(self.action, self.client.decoder(self.reply_string(id)))
+
+    def stream(self, id=0, chunk_size=65536):
+        """ Return an iterator over the content returned by the request for id, e.g. for screenshot/thumbnail. """
+        return self.client.return_reply_stream(self.make_url(id), chunk_size)
+
+
+class _Flight(object):
+    def __init__(self):
+        self.future = BrowshotFuture()
+        self.expires = None
+
+
+class BrowshotCoalescer(object):
+    def __init__(self, window=5, charged=('simple', 'screenshot/create', 'screenshot/multiple', 'crawl/create')):
+        """ Share one API call between identical requests: a request sent while the same request is in progress waits for its reply instead of being sent again. The coalescer can be shared by several clients using the same API key.
+
+        Requests are identical if they have the same action and the same parameters, in any order. The replies of the actions that use credits are also kept for <window> seconds, so that the same screenshot requested again shortly after is not paid twice.
+
+        Arguments:
+            window: number of seconds the replies of charged actions are reused. 5 seconds by default. Set to 0 to only share the requests in progress.
+            charged: actions that use credits.
+        """
+        self.window = window
+        self.charged = charged
+        self.calls = 0
+        self.shared = 0
+
+        self._flights = {}
+        self._expiring = collections.deque()
+        self._lock = threading.Lock()
+
+    def call(self, action='', key='', function=None):
+        """ Return the result of function(), or the result of the call in progress, or recently completed for charged actions, with the same key. """
+        now = time.time()
+        with self._lock:
+            while self._expiring and self._expiring[0][0] <= now:
+                expires, expired = self._expiring.popleft()
+                flight = self._flights.get(expired)
+                if flight is not None and flight.expires == expires:
+                    del self._flights[expired]
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            return flight.future.result()
+
+        try:
+            result = function()
+        except Exception, e:
+            with self._lock:
+                del self._flights[key]
+            flight.future.set_exception(e)
+            raise
+
+        with self._lock:
+            if action in self.charged and self.window > 0:
+                flight.expires = time.time() + self.window
+                self._expiring.append((flight.expires, key))
+            else:
+                del self._flights[key]
+        flight.future.set_result(result)
+        return result
+
+    def stats(self):
+        """ Return the number of requests sent, and of requests that shared the reply of another request, as {'calls': <count>, 'shared': <count>}. """
+        with self._lock:
+            return {'calls': self.calls, 'shared': self.shared}
+
+
+class BrowshotJournal(object):
+    def __init__(self, path, sync_interval=1, batch_size=1000):
+        """ Journal of the screenshots and batches requested, kept in a SQLite database, so that a process restarted after a crash can resume its work without requesting and paying for the same screenshots again:
+
+            journal = BrowshotJournal('/var/lib/captures/journal.sqlite')
+            client = BrowshotClient(key, journal=journal)
+
+        A client with a journal records the reply of each screenshot_create, screenshot_multiple and batch_create (from a file name), and returns the recorded reply when the same request is made again instead of sending it. The statuses returned by screenshot_info, screenshot_list, screenshot_search and batch_info, and the files written by screenshot_thumbnail_file, are recorded as well. Use jobs() and unfinished() to find what is left to do.
+
+        Changes are committed, and synced to the disk, in batches: a crash loses at most the last <sync_interval> seconds. The journal can be shared by several clients and threads, and several processes can use the same file.
+
+        Arguments:
+            path (Required): file of the SQLite database. It is created if it does not exist.
+            sync_interval: maximum number of seconds between two commits. 1 second by default.
+            batch_size: number of changes after which a commit is done without waiting for sync_interval. 1000 by default.
+        """
+        self.path = path
+        self.sync_interval = sync_interval
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._changes = []
+        self._rows = 0
+        self._submissions = {}
+        self._committed = time.time()
+        self._closed = False
+
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS submissions (action TEXT NOT NULL, key TEXT NOT NULL, reply TEXT NOT NULL, created REAL NOT NULL, PRIMARY KEY (action, key))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS jobs (kind TEXT NOT NULL, id INTEGER NOT NULL, url TEXT, status TEXT, file TEXT, updated REAL NOT NULL, PRIMARY KEY (kind, id))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_url ON jobs (url)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (kind, status)')
+
+        self._thread = threading.Thread(target=self._sync, name='browshot-journal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submission(self, action='', key=''):
+        """ Return the recorded reply of a request, or None if it was never recorded. """
+        with self._lock:
+            reply = self._submissions.get((action, key))
+            if reply is None:
+                row = self._db.execute('SELECT reply FROM submissions WHERE action = ? AND key = ?', (action, key)).fetchone()
+                if row is None:
+                    return None
+                reply = row[0]
+        return simplejson.loads(reply)
+
+    def submitted(self, action='', key=None, reply=None, url=None):
+        """ Record the reply of screenshot_create, screenshot_multiple or batch_create, and the screenshots or batches it contains. key identifies the request, see BrowshotRequestBuilder.request_key. Replies without key are not returned by submission(). """
+        reply = _untyped(reply)
+        if action == 'screenshot/multiple':
+            kind, items = 'screenshot', [item for item in reply.values() if isinstance(item, dict)]
+        else:
+            kind, items = action.split('/')[0], [reply]
+
+        now = time.time()
+        rows = [(kind, int(item['id']), item.get('url', url), item.get('status'), now) for item in items if 'id' in item]
+        with self._lock:
+            if key is not None:
+                content = simplejson.dumps(reply)
+                self._submissions[(action, key)] = content
+                self._change('INSERT OR REPLACE INTO submissions (action, key, reply, created) VALUES (?, ?, ?, ?)', [(action, key, content, now)])
+            self._change('INSERT OR IGNORE INTO jobs (kind, id, url, status, updated) VALUES (?, ?, ?, ?, ?)', rows)
+
+    def observe(self, action='', reply=None):
+        """ Record the statuses found in the reply of screenshot_info, screenshot_list, screenshot_search or batch_info. Only the screenshots and batches already in the journal are updated. """
+        reply = _untyped(reply)
+        if not isinstance(reply, dict):
+            return
+
+        if action in ('screenshot/list', 'screenshot/search'):
+            kind, items = 'screenshot', [item for item in reply.values() if isinstance(item, dict)]
+        else:
+            kind, items = action.split('/')[0], [reply]
+
+        rows = [(item['status'], time.time(), kind, int(item['id'])) for item in items if 'id' in item and item.get('status')]
+        if len(rows) == 0:
+            return
+        with self._lock:
+            self._change('UPDATE jobs SET status = ?, updated = ? WHERE kind = ? AND id = ? AND status IS NOT ?', [row + (row[0],) for row in rows])
+
+    def downloaded(self, kind='screenshot', id=0, file=''):
+        """ Record the local file of a screenshot or batch. """
+        with self._lock:
+            self._change('UPDATE jobs SET file = ?, updated = ? WHERE kind = ? AND id = ?', [(file, time.time(), kind, int(id))])
+
+    def job(self, kind='screenshot', id=0):
+        """ Return the record of a screenshot or batch as {'kind': <kind>, 'id': <id>, 'url': <url>, 'status': <status>, 'file': <file>, 'updated': <time>}, or None. """
+        jobs = self._select('kind = ? AND id = ?', (kind, int(id)))
+        return jobs[0] if jobs else None
+
+    def jobs(self, kind='screenshot', url=None, status=None):
+        """ Return the records of the screenshots or batches, optionally only those of a URL or with a status. See job(). """
+        where, arguments = ['kind = ?'], [kind]
+        if url is not None:
+            where.append('url = ?')
+            arguments.append(url)
+        if status is not None:
+            where.append('status = ?')
+            arguments.append(status)
+        return self._select(' AND '.join(where), arguments)
+
+    def unfinished(self, kind='screenshot'):
+        """ Return the records of the screenshots or batches still in progress, and of those finished but not downloaded. See job(). """
+        return self._select("kind = ? AND (status IS NULL OR status NOT IN ('finished', 'error') OR (status = 'finished' AND file IS NULL))", (kind,))
+
+    def flush(self):
+        """ Commit the changes not committed yet. """
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        """ Commit the last changes and close the database. """
+        with self._lock:
+            if self._closed:
+                return
+            self._commit()
+            self._closed = True
+            self._db.close()
+
+    def _select(self, where, arguments):
+        with self._lock:
+            self._commit()
+            rows = self._db.execute('SELECT kind, id, url, status, file, updated FROM jobs WHERE ' + where + ' ORDER BY id', arguments).fetchall()
+        return [dict(zip(('kind', 'id', 'url', 'status', 'file', 'updated'), row)) for row in rows]
+
+    def _change(self, statement, rows):
+        self._changes.append((statement, rows))
+        self._rows += len(rows)
+        if self._rows >= self.batch_size or time.time() - self._committed >= self.sync_interval:
+            self._commit()
+
+    def _commit(self):
+        # The changes are kept in memory and written at once, so that the database is locked only while they are written
+        if len(self._changes) > 0 and not self._closed:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                for statement, rows in self._changes:
+                    self._db.executemany(statement, rows)
+                self._db.execute('COMMIT')
+            except:
+                self._db.execute('ROLLBACK')
+                raise
+            self._changes = []
+            self._rows = 0
+            self._submissions = {}
+        self._committed = time.time()
+
+    def _sync(self):
+        while True:
+            time.sleep(self.sync_interval)
+            with self._lock:
+                if self._closed:
+                    return
+                if time.time() - self._committed >= self.sync_interval:
+                    self._commit()
+
+
+def _untyped(reply):
+    """ Return a reply of BrowshotResult objects as dictionaries. """
+    if isinstance(reply, BrowshotResult):
+        return reply.to_dict()
+    if isinstance(reply, dict):
+        return dict((key, value.to_dict() if isinstance(value, BrowshotResult) else value) for key, value in reply.items())
+    return reply
+
 
 class BrowshotClient(object):
-    def __init__(self, key='', debug=0, base='https://api.browshot.com/api/v1/'):
+    def __init__(self, key='', debug=0, base='https://api.browshot.com/api/v1/', transport=None, metadata_cache=None, screenshot_cache=None, rate_limiter=None, credit_governor=None, retry_policy=None, decoder=None, typed=False, metrics=None, coalescer=None, journal=None):
         """ Create a new BrowshotClient object. You must pass your API key (go to you Dashboard to find your API key, https://browshot.com/dashboard).
 
+        A BrowshotClient can be used by several threads at the same time: the parameters passed to its methods are never modified, and the transport, caches, rate limiter, credit governor and retry policy are thread-safe.
+
         Arguments:
             key:  API key.
-            debug: Set to 1 to print debug output to the standard output. 0 (disabled) by default.
+            debug: Set to 1 to print debug output to the standard output, with the API key removed. 0 (disabled) by default.
             base: Base URL for all API requests. You should use the default base provided by the library. Be careful if you decide to use HTTP instead of HTTPS as your API key could be sniffed and your account could be used without your consent.
+            transport: BrowshotTransport object used to send the requests. A transport can be shared by several clients. A new BrowshotTransport with the default settings is created by default.
+            metadata_cache: BrowshotMetadataCache object to cache the instances and browsers details. Disabled by default.
+            screenshot_cache: BrowshotScreenshotCache object to keep the images returned by simple and screenshot_thumbnail on disk. Disabled by default.
+            rate_limiter: BrowshotRateLimiter object to limit the number of requests per second. Disabled by default.
+            credit_governor: BrowshotCreditGovernor object to hold screenshot_create and screenshot_multiple until enough credits are available. Disabled by default.
+            retry_policy: BrowshotRetryPolicy object to send the requests again after temporary failures. Disabled by default.
+            decoder: function decoding the JSON replies. orjson or ujson is used if installed, simplejson otherwise.
+            typed: Set to True to return BrowshotScreenshot, BrowshotInstance, BrowshotBrowser, BrowshotBatch and BrowshotCrawl objects instead of dictionaries. False by default.
+            metrics: BrowshotMetrics object to record the latency, bytes, retries and cache hits of the requests. Disabled by default.
+            coalescer: BrowshotCoalescer object to send identical requests made at the same time only once. Disabled by default.
+            journal: BrowshotJournal object to record the screenshots and batches requested, and to avoid requesting them again after a restart. Disabled by default.
         """
         self.key = key
         self.base = base
         self.debug = debug
+        self.metadata_cache = metadata_cache
+        self.screenshot_cache = screenshot_cache
+        self.rate_limiter = rate_limiter
+        self.credit_governor = credit_governor
+        self.retry_policy = retry_policy
+        self.decoder = decoder or json_loads
+        self.typed = typed
+        self.metrics = metrics
+        self.coalescer = coalescer
+        self.journal = journal
+        self.request_builder = BrowshotRequestBuilder(base, key)
+
+        if transport is None:
+            transport = BrowshotTransport()
+        self.transport = transport
+
+    def close(self):
+        """ Close the connections opened by the transport. """
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
 
     def api_version(self):
         """ Return the API version handled by the library. Note that this library can usually handle new arguments in requests without requiring an update. """
@@ -63,23 +1669,33 @@ class BrowshotClient(object):
                 <code>: 200 if successful
                 <content>: PNG file
         """
-        parameters.update({'url': url})
+        parameters = dict(parameters, url=url)
         uri = self.make_url('simple', parameters)
         if self.debug:
-            print uri
+            print _redact(uri)
 
         try:
-            response = urlopen(uri)
-
-            return {'code': 200, 'png': response.read()}
-        except HTTPError, e:
-            return {'code': e.code, 'png': ''}
+            if self.screenshot_cache is not None:
+                entry = self.return_reply_cached('simple', parameters, self._simple_max_age(parameters))
+                return {'code': 200, 'png': self.screenshot_cache.read(entry) if entry is not None else ''}
+
+            code, png = self.coalesce('simple', parameters, lambda: self._simple_reply(uri))
+            return {'code': code, 'png': png}
+        except BrowshotError, e:
+            return {'code': e.code or 400, 'png': ''}
         except Exception, e:
             return {'code': 400, 'png': ''}
 
+    def _simple_reply(self, uri):
+        response = self.send_request('GET', uri)
+        if response.status_code >= 400:
+            return (response.status_code, '')
 
+        return (200, response.content)
 
-    def simple_file(self, url='', file='', parameters={}):
+
+
+    def simple_file(self, url='', file='', parameters={}, expected_size=None):
         """ Retrieve a screenshot, or a thumbnail, and save it to a fil in one functione.
 
         Note: by default, screenshots are cached for 24 hours. You can tune this valu with the cache=X parameter.
@@ -91,16 +1707,43 @@ class BrowshotClient(object):
         Arguments:
         See https://browshot.com/api/documentation#simple for the full list of possible arguments.
             url (Required): URL of the screenshot
-            file (Required): local file to store the screenshot
+            file (Required): local file to store the screenshot, or a file object opened for writing
+            expected_size: the download fails if the size of the image, in bytes, is different
+
+        The image is written to the file as it is downloaded, without being kept in memory. A local file is only created once the download is complete.
          """
-        data = self.simple(url, parameters);
-        if len(data['png']) > 0:
-            image = open(file, mode='wb')
-            image.write(data['png'])
-            image.close();
-            return {'code': data['code'], 'file': file}
+        parameters = dict(parameters, url=url)
+
+        try:
+            size = _save_chunks(self._stream('simple', parameters, max_age=self._simple_max_age(parameters)), file, expected_size)
+        except BrowshotError, e:
+            return {'code': e.code or 400, 'file': ''}
+        except requests.RequestException, e:
+            return {'code': 400, 'file': ''}
+
+        if size > 0:
+            return {'code': 200, 'file': file}
+
+        return {'code': 200, 'file': ''}
 
-        return {'code': data['code'], 'file': ''}
+    def simple_iter(self, url='', parameters={}, chunk_size=65536):
+        """ Retrieve a screenshot in one function, and return an iterator over the content of the image. The image is never held in memory as a whole.
+
+        BrowshotError is raised if the screenshot cannot be retrieved.
+
+        Arguments:
+        See https://browshot.com/api/documentation#simple for the full list of possible arguments.
+            url (Required): URL of the screenshot
+            chunk_size: maximum size of each chunk, in bytes. 64KB by default.
+        """
+        parameters = dict(parameters, url=url)
+        return self._stream('simple', parameters, chunk_size, self._simple_max_age(parameters))
+
+    def _simple_max_age(self, parameters):
+        try:
+            return int(parameters.get('cache', 24 * 60 * 60))
+        except ValueError:
+            return 0
 
 
     def instance_list(self):
@@ -139,8 +1782,8 @@ class BrowshotClient(object):
             See https://browshot.com/api/documentation#screenshot_create for the full list of possible arguments.
                 url(Required): URL of the website to create a screenshot of.
         """
-        parameters.update({'url': url})
-        return self.return_reply('screenshot/create', parameters)
+        parameters = dict(parameters, url=url)
+        return self.return_reply_charged('screenshot/create', parameters)
 
     def screenshot_info(self, id=0, parameters={}):
         """ Get information about a screenshot requested previously. See https://browshot.com/api/documentation#screenshot_info for the response format.
@@ -148,13 +1791,23 @@ class BrowshotClient(object):
             Arguments:
                 id (Required): Screenshot ID.
         """
-        parameters.update({'id': id})
+        parameters = dict(parameters, id=id)
         return self.return_reply('screenshot/info', parameters)
 
     def screenshot_list(self, parameters={}):
         """ Get details about screenshot requested. See https://browshot.com/api/documentation#screenshot_list for the response format. """
         return self.return_reply('screenshot/list', parameters)
 
+    def screenshot_list_iter(self, parameters={}, page_size=100, prefetch=True):
+        """ Return an iterator over all the screenshots returned by screenshot_list, requesting pages of <page_size> screenshots with the limit and offset arguments as needed. See https://browshot.com/api/documentation#screenshot_list for the format of each screenshot.
+
+            Arguments:
+            See https://browshot.com/api/documentation#screenshot_list for the full list of possible arguments.
+                page_size: number of screenshots requested at once. 100 by default.
+                prefetch: Set to False to request the next page only once the current page has been read. By default, the next page is requested in the background while the current page is read.
+        """
+        return self.return_reply_pages('screenshot/list', parameters, page_size, prefetch)
+
     def screenshot_host(self, id=0, parameters={}):
         """ Host a screenshot or a thumbnail. See https://browshot.com/api/documentation#screenshot_host for the response format.
 
@@ -162,7 +1815,7 @@ class BrowshotClient(object):
             See https://browshot.com/api/documentation#screenshot_host for the full list of possible arguments.
                 id (Required): screenshot ID
         """
-        parameters.update({'id': id})
+        parameters = dict(parameters, id=id)
         return self.return_reply('screenshot/host', parameters)
 
     def screenshot_share(self, id=0, parameters={}):
@@ -172,7 +1825,7 @@ class BrowshotClient(object):
             See https://browshot.com/api/documentation#screenshot_share for the full list of possible arguments.
                 id (Required): screenshot ID
         """
-        parameters.update({'id': id})
+        parameters = dict(parameters, id=id)
         return self.return_reply('screenshot/share', parameters)
 
     def screenshot_search(self, url='', parameters={}):
@@ -182,9 +1835,20 @@ class BrowshotClient(object):
             See https://browshot.com/api/documentation#screenshot_search for the full list of possible arguments.
                 url (Required): URL string to match
         """
-        parameters.update({'url': url})
+        parameters = dict(parameters, url=url)
         return self.return_reply('screenshot/search', parameters)
 
+    def screenshot_search_iter(self, url='', parameters={}, page_size=100, prefetch=True):
+        """ Return an iterator over all the screenshots returned by screenshot_search. See screenshot_list_iter.
+
+            Arguments:
+            See https://browshot.com/api/documentation#screenshot_search for the full list of possible arguments.
+                url (Required): URL string to match
+                page_size: number of screenshots requested at once. 100 by default.
+                prefetch: Set to False to request the next page only once the current page has been read. True by default.
+        """
+        return self.return_reply_pages('screenshot/search', dict(parameters, url=url), page_size, prefetch)
+
     def screenshot_delete(self, id=0, parameters={}):
         """ Delete details of a screenshot. See L<http://browshot.com/api/documentation#screenshot_delete> for the response format.
 
@@ -192,7 +1856,7 @@ class BrowshotClient(object):
             See https://browshot.com/api/documentation#screenshot_delete for the full list of possible arguments.
                 id (Required): screenshot ID
         """
-        parameters.update({'id': id})
+        parameters = dict(parameters, id=id)
         return self.return_reply('screenshot/delete', parameters)
 
     def screenshot_thumbnail(self, id=0, parameters={}):
@@ -202,27 +1866,44 @@ class BrowshotClient(object):
             See https://browshot.com/api/documentation#screenshot_thumbnail for the full list of possible arguments.
                 id (Required): screenshot ID. You will get the full image if no other argument is specified.
         """
-        parameters.update({'id': id})
+        parameters = dict(parameters, id=id)
+        if self.screenshot_cache is not None:
+            entry = self.return_reply_cached('screenshot/thumbnail', parameters)
+            return self.screenshot_cache.read(entry) if entry is not None else ''
+
         url = self.make_url('screenshot/thumbnail', parameters)
-        response = urllib.urlopen(url)
-        return response.read()
+        return self.coalesce('screenshot/thumbnail', parameters, lambda: self.send_request('GET', url).content)
 
-    def screenshot_thumbnail_file(self, id=0, file='', parameters={}):
+    def screenshot_thumbnail_iter(self, id=0, parameters={}, chunk_size=65536):
+        """ Retrieve the screenshot, or a thumbnail, and return an iterator over the content of the image. The image is never held in memory as a whole.
+
+            BrowshotError is raised if the image cannot be retrieved.
+
+            Arguments:
+            See https://browshot.com/api/documentation#screenshot_thumbnail for the full list of possible arguments.
+                id (Required): screenshot ID. You will get the full image if no other argument is specified.
+                chunk_size: maximum size of each chunk, in bytes. 64KB by default.
+        """
+        parameters = dict(parameters, id=id)
+        return self._stream('screenshot/thumbnail', parameters, chunk_size)
+
+    def screenshot_thumbnail_file(self, id=0, file='', parameters={}, expected_size=None):
         """ Retrieve the screenshot, or a thumbnail, and save it to a file. See http://browshot.com/api/documentation#screenshot_thumbnail for the response format.
 
-        Returns the file name if successful.
+        Returns the file name if successful. BrowshotError is raised if the image cannot be retrieved.
+
+        The image is written to the file as it is downloaded, without being kept in memory. A local file is only created once the download is complete.
 
         Arguments:
         See https://browshot.com/api/documentation#screenshot_thumbnail for the full list of possible arguments.
             id (Required): screenshot ID. You will get the full image if no other argument is specified.
-            file (Required): local file to store the screenshot
+            file (Required): local file to store the screenshot, or a file object opened for writing
+            expected_size: the download fails if the size of the image, in bytes, is different
          """
-        content = self.screenshot_thumbnail(id, parameters);
-
-        image = open(file, mode='wb')
-        image.write(content)
-        image.close();
+        _save_chunks(self.screenshot_thumbnail_iter(id, parameters), file, expected_size)
 
+        if self.journal is not None and isinstance(file, basestring):
+            self.journal.downloaded('screenshot', id, os.path.abspath(file))
         return file
 
     def screenshot_html(self, id=0, parameters={}):
@@ -232,7 +1913,7 @@ class BrowshotClient(object):
             See https://browshot.com/api/documentation#screenshot_html for the full list of possible arguments.
                 id (Required): screenshot ID
         """
-        parameters.update({'id': id})
+        parameters = dict(parameters, id=id)
         return self.return_reply_string('screenshot/html', parameters)
 
 
@@ -242,17 +1923,58 @@ class BrowshotClient(object):
             Arguments:
             See https://browshot.com/api/documentation#screenshot_multiple for the full list of possible arguments.
         """
-        return self.return_reply('screenshot/multiple', parameters)
+        return self.return_reply_charged('screenshot/multiple', parameters)
 
 
-    def batch_create(self, file='', parameters={}):
+    def batch_create(self, file='', parameters={}, compress=False):
         """ Request multiple screenshots from a file. See https://browshot.com/api/documentation#batch_create for the response format.
 
+            The list of URLs is sent as it is read, it is never held in memory as a whole.
+
             Arguments:
             See https://browshot.com/api/documentation#batch_create for the full list of possible arguments.
-                file (Required): file with hhe list of URLs to capture
+                file (Required): file with hhe list of URLs to capture, a file object, or any iterable of URLs (list, generator, etc.)
+                compress: Set to True to compress the request with gzip. The server must accept compressed requests. False by default.
         """
-        return self.return_post_reply('batch/create', file, parameters)
+        journal = self.journal
+        if journal is None:
+            return self.return_post_reply('batch/create', file, parameters, compress)
+
+        # A file name identifies the request, other sources of URLs cannot be read twice
+        key = None
+        if isinstance(file, basestring):
+            key = self.builder().request_key('batch/create', dict(parameters, file=os.path.abspath(file)))
+            reply = journal.submission('batch/create', key)
+            if reply is not None:
+                return self.return_typed('batch/create', reply)
+
+        reply = self.return_post_reply('batch/create', file, parameters, compress)
+        if isinstance(reply, (dict, BrowshotResult)) and not 'error' in reply:
+            journal.submitted('batch/create', key, reply)
+        return reply
+
+    def batch_create_many(self, file='', parameters={}, batch_size=100000, compress=False):
+        """ Request multiple screenshots from a list of URLs, split in several batches of at most <batch_size> URLs. Return the list of batch_create replies, one per batch.
+
+            Arguments:
+            See https://browshot.com/api/documentation#batch_create for the full list of possible arguments.
+                file (Required): file with the list of URLs to capture, a file object, or any iterable of URLs (list, generator, etc.)
+                batch_size: maximum number of URLs per batch. 100,000 by default.
+                compress: Set to True to compress the requests with gzip. The server must accept compressed requests. False by default.
+        """
+        if isinstance(file, basestring):
+            with open(file, 'rb') as handle:
+                return self.batch_create_many(handle, parameters, batch_size, compress)
+
+        urls = (url for url in file if url.strip() != '')
+        replies = []
+        while True:
+            try:
+                first = next(urls)
+            except StopIteration:
+                return replies
+
+            replies.append(self.batch_create(itertools.chain([first], itertools.islice(urls, batch_size - 1)), dict(parameters), compress))
 
 
     def batch_info(self, id=0, parameters={}):
@@ -262,7 +1984,7 @@ class BrowshotClient(object):
             See https://browshot.com/api/documentation#batch_info for the full list of possible arguments.
                 id (Required): batch ID
         """
-        parameters.update({'id': id})
+        parameters = dict(parameters, id=id)
         return self.return_reply('batch/info', parameters)
 
 
@@ -274,8 +1996,7 @@ class BrowshotClient(object):
                 domain (Required): domain to crawl
                 url (Required): URL to start with
         """
-        parameters.update({'url': url})
-        parameters.update({'domain': domain})
+        parameters = dict(parameters, url=url, domain=domain)
         return self.return_reply('crawl/create', parameters)
 
 
@@ -286,7 +2007,7 @@ class BrowshotClient(object):
             See https://browshot.com/api/documentation#crawl_info for the full list of possible arguments.
                 id (Required): crawl ID
         """
-        parameters.update({'id': id})
+        parameters = dict(parameters, id=id)
         return self.return_reply('crawl/info', parameters)
 
 
@@ -296,70 +2017,1927 @@ class BrowshotClient(object):
 
 
     def make_url(self, action='', parameters={}):
-        url = self.base + action + '?key=' + urllib.quote_plus(self.key)
-
-        for key, value in parameters.items():
-            if key == 'urls':
-              for uri in value:
-                url += '&url=' + urllib.quote_plus(str(uri))
-            elif key == 'instances':
-              for instance_id in value:
-                url += '&instance_id=' + urllib.quote_plus(str(instance_id))
-            else:
-              url += '&' + urllib.quote_plus(key) + '=' + urllib.quote_plus(str(value))
+        url = self.builder().url(action, parameters)
 
         if self.debug:
-            print url
+            print _redact(url)
 
         return url
 
+    def builder(self):
+        """ Return the BrowshotRequestBuilder for the current key and base. """
+        builder = self.request_builder
+        if builder.key != self.key or builder.base != self.base:
+            builder = BrowshotRequestBuilder(self.base, self.key, builder.max_url_length)
+            self.request_builder = builder
+        return builder
+
+    def coalesce(self, action='', parameters={}, function=None):
+        """ Return function(), or share the result of an identical request in progress if the client has a coalescer. """
+        if self.coalescer is None:
+            return function()
+        return self.coalescer.call(action, self.builder().request_key(action, parameters), function)
+
+    def prepare(self, action='', parameters={}):
+        """ Return a BrowshotPreparedRequest for action, to send the same request for many IDs.
+
+            Arguments:
+                action (Required): API action, e.g. 'screenshot/info'
+                parameters: parameters shared by all the requests, except id
+        """
+        return BrowshotPreparedRequest(self, action, parameters)
+
+
+    def send_request(self, method='GET', url='', stream=False, headers=None, data=None, files=None):
+        """ Send a request through the transport and return the requests.Response object. """
+        attempts = [0]
+
+        def send():
+            attempts[0] += 1
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            if method == 'POST':
+                for handle in (files or {}).values():
+                    if hasattr(handle, 'seek'):
+                        handle.seek(0)
+                return self.transport.post(url, data=data, files=files, headers=headers)
+            return self.transport.get(url, stream=stream, headers=headers)
+
+        def request():
+            if self.retry_policy is None:
+                return send()
+            return self.retry_policy.call(url[len(self.base):].split('?')[0], send)
+
+        if self.metrics is None:
+            return request()
+
+        span = {'action': url[len(self.base):].split('?')[0], 'method': method, 'url': _redact(url), 'sent': len(url), 'received': 0}
+        if isinstance(data, basestring):
+            span['sent'] += len(data)
+        elif data is not None:
+            data = _counted(data, span)
+
+        timings = getattr(self.transport, 'timings', None)
+        if timings is not None:
+            timings()
+
+        span['start'] = time.time()
+        try:
+            response = request()
+        except Exception, e:
+            span.update(timings() if timings is not None else {}, end=time.time(), retries=attempts[0] - 1, error=str(e))
+            self.metrics.record(span)
+            raise
+
+        span.update(timings() if timings is not None else {}, status=response.status_code, retries=attempts[0] - 1)
+        if stream:
+            span['ttfb'] = time.time() - span['start']
+            return _MeteredResponse(response, span, self.metrics)
+
+        span['end'] = time.time()
+        elapsed = getattr(response, 'elapsed', None)
+        span['ttfb'] = min(elapsed.total_seconds(), span['end'] - span['start']) if elapsed is not None else span['end'] - span['start']
+        span['received'] = len(response.content)
+        self.metrics.record(span)
+        return response
+
 
     def return_reply(self, action='', parameters={}):
+        cache = self.metadata_cache
+        if cache is not None and cache.handles(action):
+            reply = cache.get(action, parameters)
+            if self.metrics is not None:
+                self.metrics.cache('metadata', reply is not None)
+            if reply is not None:
+                return self.return_typed(action, reply)
+
         content = self.return_reply_string(action, parameters);
 
         try:
-            json_decode = simplejson.loads(content)
-            return json_decode
+            json_decode = self.decoder(content)
         except Exception, e:
             raise e
 
+        if cache is not None and cache.handles(action) and not (isinstance(json_decode, dict) and 'error' in json_decode):
+            cache.set(action, parameters, json_decode)
+
+        if self.journal is not None and action in ('screenshot/info', 'screenshot/list', 'screenshot/search', 'batch/info'):
+            self.journal.observe(action, json_decode)
+
+        return self.return_typed(action, json_decode)
+
+    def return_typed(self, action='', reply=None):
+        """ Return the decoded reply of action as BrowshotResult objects if the client was created with typed=True, unchanged otherwise. """
+        if not self.typed:
+            return reply
+        return _typed(action, reply)
+
+
+    def return_reply_items(self, action='', parameters={}):
+        """ Return an iterator over the (key, value) pairs of a reply, decoded while the reply is received. BrowshotError is raised if the reply is an error. """
+        response = self.send_request('GET', self.make_url(action, parameters), stream=True)
+        try:
+            for key, value in _json_object_items(response.iter_content(65536)):
+                if key == 'error' and not isinstance(value, dict):
+                    raise BrowshotError(value, response.status_code)
+                yield key, value
+        finally:
+            response.close()
+
+
+    def return_reply_pages(self, action='', parameters={}, page_size=100, prefetch=True):
+        offset = int(parameters.get('offset', 0))
+
+        def page(offset):
+            return self.return_reply_items(action, dict(parameters, limit=page_size, offset=offset))
+
+        if prefetch:
+            next_page = BrowshotFuture()
+            next_page.set_result(list(page(offset)))
+
+        while True:
+            if prefetch:
+                items = next_page.result()
+                if len(items) >= page_size:
+                    # Request the next page while this one is read
+                    next_page = self._background(lambda offset=offset + page_size: list(page(offset)))
+            else:
+                items = page(offset)
+
+            count = 0
+            for key, screenshot in items:
+                count += 1
+                if self.typed:
+                    screenshot = BrowshotScreenshot(screenshot)
+                yield screenshot
+
+            if count < page_size:
+                return
+            offset += page_size
+
+    def _background(self, function):
+        future = BrowshotFuture()
+
+        def run():
+            try:
+                future.set_result(function())
+            except Exception, e:
+                future.set_exception(e)
+
+        thread = threading.Thread(target=run, name='browshot-prefetch')
+        thread.daemon = True
+        thread.start()
+        return future
+
+
+    def return_reply_charged(self, action='', parameters={}):
+        journal = self.journal
+        if journal is None:
+            return self._charged_reply(action, parameters)
+
+        # Never pay twice for a request already made
+        key = self.builder().request_key(action, parameters)
+        reply = journal.submission(action, key)
+        if reply is not None:
+            return self.return_typed(action, reply)
+
+        reply = self._charged_reply(action, parameters)
+        if isinstance(reply, (dict, BrowshotResult)) and not 'error' in reply:
+            journal.submitted(action, key, reply, parameters.get('url'))
+        return reply
+
+    def _charged_reply(self, action='', parameters={}):
+        governor = self.credit_governor
+        if governor is None:
+            return self.return_reply(action, parameters)
+
+        # Only the request actually sent reserves credits
+        content = self.coalesce(action, parameters, lambda: self._charged_string(action, parameters))
+        return self.return_typed(action, self.decoder(content))
+
+    def _charged_string(self, action='', parameters={}):
+        governor = self.credit_governor
+        credits = governor.cost(action, parameters)
+        governor.reserve(credits)
+        try:
+            content = self._reply_string(action, parameters)
+            reply = self.decoder(content)
+        except:
+            governor.release(credits)
+            raise
+
+        governor.release(credits, not (isinstance(reply, dict) and 'error' in reply))
+        return content
+
 
     def return_reply_string(self, action='', parameters={}):
+        return self.coalesce(action, parameters, lambda: self._reply_string(action, parameters))
+
+    def _reply_string(self, action='', parameters={}):
         try:
-            url    = self.make_url(action, parameters)
+            method, url, body = self.builder().request(action, parameters)
+            if self.debug:
+                print _redact(url)
 
-            response = urllib.urlopen(url)
-            return response.read()
+            if body is None:
+                response = self.send_request('GET', url)
+            else:
+                # Too many parameters for the URL
+                response = self.send_request('POST', url, data=body, headers={'Content-Type': 'application/x-www-form-urlencoded'})
+            return response.content
         except Exception, e:
             raise e
 
 
 
-    def return_post_reply(self, action='', file='', parameters={}):
-        content = self.return_reply_post_string(action, file, parameters);
+    def return_reply_stream(self, url='', chunk_size=65536):
+        """ Return an iterator over the content returned by url. The request is sent when the iteration starts, and the connection goes back to the pool when it ends. """
+        response = self.send_request('GET', url, stream=True)
+        try:
+            if response.status_code >= 400:
+                raise BrowshotError('HTTP error %d' % response.status_code, response.status_code)
+
+            for chunk in response.iter_content(chunk_size):
+                if chunk:
+                    yield chunk
+        finally:
+            response.close()
+
+
+    def return_reply_cached(self, action='', parameters={}, max_age=None):
+        """ Return the screenshot cache entry for a request, sending the request only if the image is not in the cache or is stale. Return None if the image is empty. """
+        cache = self.screenshot_cache
+        key = action + '?' + urllib.urlencode(sorted((str(name), str(value)) for name, value in parameters.items()))
+
+        entry = cache.lookup(key, max_age)
+        if self.metrics is not None:
+            self.metrics.cache('screenshot', entry is not None and not entry['stale'])
+        if entry is not None and not entry['stale']:
+            return entry
+
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self.send_request('GET', self.make_url(action, parameters), stream=True, headers=headers or None)
+        try:
+            if response.status_code == 304 and entry is not None:
+                return cache.refresh(key, entry)
+            if response.status_code >= 300:
+                raise BrowshotError('HTTP error %d' % response.status_code, response.status_code)
+
+            return cache.store(key, response.iter_content(65536), response.headers)
+        finally:
+            response.close()
+
+    def _stream(self, action='', parameters={}, chunk_size=65536, max_age=None):
+        if self.screenshot_cache is None:
+            return self.return_reply_stream(self.make_url(action, parameters), chunk_size)
+
+        entry = self.return_reply_cached(action, parameters, max_age)
+        if entry is None:
+            return iter([])
+        return self.screenshot_cache.iter(entry, chunk_size)
+
+
+    def return_post_reply(self, action='', file='', parameters={}, compress=False):
+        content = self.return_reply_post_string(action, file, parameters, compress);
 
         try:
-            json_decode = simplejson.loads(content)
-            return json_decode
+            json_decode = self.decoder(content)
+            return self.return_typed(action, json_decode)
         except Exception, e:
             raise e
 
 
-    def return_reply_post_string(self, action='', file='', parameters={}):
+    def return_reply_post_string(self, action='', file='', parameters={}, compress=False):
         try:
             url = self.make_url(action, parameters)
 
-            if file == '':
-              response = urllib.urlopen(url)
-              return response.read()
+            if isinstance(file, basestring) and file == '':
+              response = self.send_request('GET', url)
+              return response.content
 
             else:
-              response = requests.post(url, files={'file': open(file,'rb')})
+              # The body is streamed with chunked transfer encoding
+              boundary = hashlib.sha1(str(random.random())).hexdigest()
+              headers = {'Content-Type': 'multipart/form-data; boundary=' + boundary}
+              if compress:
+                headers['Content-Encoding'] = 'gzip'
+
+              filename = 'urls.txt'
+              if isinstance(file, basestring):
+                filename = os.path.basename(file)
+
+              response = self.send_request('POST', url, data=_multipart('file', filename, _url_chunks(file), boundary, compress), headers=headers)
               return response.content
 
         except Exception, e:
             raise e
 
 
+class AsyncBrowshotClient(object):
+    def __init__(self, key='', debug=0, base='https://api.browshot.com/api/v1/', transport=None, concurrency=10, client=None):
+        """ Create a new AsyncBrowshotClient object. It has the same methods as BrowshotClient, but each request runs in the background and a BrowshotFuture is returned immediately:
+
+            future = client.screenshot_info(id)
+            ...
+            info = future.result()
+
+        All the requests share the same connection pool, and at most <concurrency> requests are sent at the same time; the other requests are queued.
+
+        Arguments:
+            key, debug, base, transport: see BrowshotClient. The default transport keeps one connection per concurrent request.
+            concurrency: maximum number of requests sent at the same time. 10 by default.
+            client: BrowshotClient object to use instead of creating a new one. key, debug, base and transport are ignored if client is set.
+        """
+        if client is None:
+            if transport is None:
+                transport = BrowshotTransport(pool_size=concurrency)
+            client = BrowshotClient(key, debug, base, transport)
+
+        self.client = client
+        self.concurrency = concurrency
+        self.pool = BrowshotWorkerPool(concurrency)
+
+    def api_version(self):
+        """ Return the API version handled by the library. """
+        return self.client.api_version()
+
+    def make_url(self, action='', parameters={}):
+        return self.client.make_url(action, parameters)
+
+    def close(self):
+        """ Wait for the queued requests to complete, then close the connections. """
+        self.pool.shutdown()
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _submit(self, name, args, kwargs):
+        method = getattr(self.client, name)
+
+        # Each request gets its own parameters: the defaults of BrowshotClient are updated in place and must not be shared between threads
+        names = inspect.getargspec(method).args[1:]
+        args = [dict(arg) if isinstance(arg, dict) else arg for arg in args]
+        kwargs = dict((key, dict(value) if isinstance(value, dict) else value) for key, value in kwargs.items())
+        if 'parameters' in names and names.index('parameters') >= len(args) and not 'parameters' in kwargs:
+            kwargs['parameters'] = {}
+
+        return self.pool.submit(method, *args, **kwargs)
+
+
+def _async_method(name):
+    def method(self, *args, **kwargs):
+        return self._submit(name, args, kwargs)
+
+    method.__name__ = name
+    method.__doc__ = """ Run BrowshotClient.%s() in the background and return a BrowshotFuture for its reply. """ % name
+    return method
+
+for _name in ('simple', 'simple_file', 'instance_list', 'instance_info', 'browser_list', 'browser_info',
+              'screenshot_create', 'screenshot_info', 'screenshot_list', 'screenshot_host', 'screenshot_share',
+              'screenshot_search', 'screenshot_delete', 'screenshot_thumbnail', 'screenshot_thumbnail_file',
+              'screenshot_html', 'screenshot_multiple', 'batch_create', 'batch_create_many', 'batch_info', 'crawl_create', 'crawl_info',
+              'account_info'):
+    setattr(AsyncBrowshotClient, _name, _async_method(_name))
+
+
+class _Tracked(object):
+    def __init__(self, id, deadline, interval):
+        self.id = id
+        self.deadline = deadline
+        self.interval = interval
+        self.future = BrowshotFuture()
+
+
+class BrowshotTracker(object):
+    def __init__(self, client, workers=10, poll_interval=2, max_poll_interval=30, backoff=1.5, timeout=300, sweep_threshold=20, sweep_limit=100, callback=None, pool=None):
+        """ Wait for many screenshots to be finished. Screenshots added to the tracker are checked in the background until they are finished or failed:
+
+            tracker = BrowshotTracker(client)
+            for id in ids:
+                tracker.add(id)
+            for future in tracker.completed():
+                screenshot = future.result()
+
+        Each screenshot has its own schedule: the time between two checks grows while the screenshot is in queue, and is reset once it is processing. When many screenshots are due at the same time, a single screenshot_list call is used to get the status of all the recent screenshots, and screenshot_info is only called for the screenshots not found in the list.
+
+        Arguments:
+            client: BrowshotClient object used to send the requests.
+            workers: maximum number of requests sent at the same time. 10 by default.
+            poll_interval: seconds to wait before the first check. 2 seconds by default.
+            max_poll_interval: maximum number of seconds between two checks. 30 seconds by default.
+            backoff: the time between two checks is multiplied by this factor while the screenshot is in queue. 1.5 by default.
+            timeout: default maximum number of seconds to wait for a screenshot. 5 minutes by default.
+            sweep_threshold: minimum number of screenshots due at the same time to use screenshot_list. 20 by default. Set to 0 to never use screenshot_list.
+            sweep_limit: number of screenshots requested from screenshot_list. 100 by default.
+            callback: function called with the BrowshotFuture of each screenshot once it is finished or failed.
+            pool: BrowshotWorkerPool used to send the requests. A new pool of <workers> threads is created by default.
+        """
+        self.client = client
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.sweep_threshold = sweep_threshold
+        self.sweep_limit = sweep_limit
+        self.callback = callback
+
+        self._own_pool = pool is None
+        if pool is None:
+            pool = BrowshotWorkerPool(workers)
+        self.pool = pool
+
+        self._tracked = {}
+        self._queue = []
+        self._sequence = 0
+        self._completed = Queue.Queue()
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._schedule, name='browshot-tracker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, id=0, timeout=None):
+        """ Start tracking a screenshot and return a BrowshotFuture for its final screenshot_info reply, with the status finished or error. The future raises BrowshotError if the screenshot is not finished in time.
+
+            Arguments:
+                id (Required): screenshot ID.
+                timeout: maximum number of seconds to wait for the screenshot. Uses the tracker timeout by default.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        with self._condition:
+            if id in self._tracked:
+                return self._tracked[id].future
+
+            tracked = _Tracked(id, time.time() + timeout, self.poll_interval)
+            self._tracked[id] = tracked
+            self._push(tracked, time.time() + tracked.interval)
+
+        return tracked.future
+
+    def pending(self):
+        """ Return the number of screenshots not finished yet. """
+        with self._condition:
+            return len(self._tracked)
+
+    def completed(self, timeout=None):
+        """ Iterate over the BrowshotFuture of the screenshots in the order they are finished, until no screenshot is left to track.
+
+            Arguments:
+                timeout: maximum number of seconds to wait for the next screenshot. BrowshotError is raised if no screenshot is finished in time. Wait forever by default.
+        """
+        while True:
+            try:
+                yield self._completed.get(False)
+                continue
+            except Queue.Empty:
+                pass
+
+            if self.pending() == 0 and self._completed.empty():
+                return
+
+            try:
+                yield self._completed.get(True, timeout)
+            except Queue.Empty:
+                raise BrowshotError('No screenshot finished after %s seconds' % timeout)
+
+    def close(self):
+        """ Stop tracking. Screenshots not finished yet are abandoned. """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+        if self._own_pool:
+            self.pool.shutdown(wait=False)
+
+    def _push(self, tracked, when):
+        self._sequence += 1
+        heapq.heappush(self._queue, (min(when, tracked.deadline), self._sequence, tracked))
+        self._condition.notify()
+
+    def _schedule(self):
+        while True:
+            with self._condition:
+                while not self._closed and (len(self._queue) == 0 or self._queue[0][0] > time.time()):
+                    if len(self._queue) == 0:
+                        self._condition.wait()
+                    else:
+                        self._condition.wait(self._queue[0][0] - time.time())
+
+                if self._closed:
+                    return
+
+                due = []
+                while len(self._queue) > 0 and self._queue[0][0] <= time.time():
+                    due.append(heapq.heappop(self._queue)[2])
+
+            if self.sweep_threshold > 0 and len(due) >= self.sweep_threshold:
+                self.pool.submit(self._sweep, due)
+            else:
+                for tracked in due:
+                    self.pool.submit(self._poll, tracked)
+
+    def _sweep(self, due):
+        try:
+            screenshots = self.client.screenshot_list({'limit': self.sweep_limit})
+        except Exception, e:
+            screenshots = {}
+
+        for tracked in due:
+            screenshot = screenshots.get(str(tracked.id)) if isinstance(screenshots, dict) else None
+            if screenshot is not None:
+                self._update(tracked, screenshot)
+            else:
+                self.pool.submit(self._poll, tracked)
+
+    def _poll(self, tracked):
+        try:
+            screenshot = self.client.screenshot_info(tracked.id, {})
+        except Exception, e:
+            # Network errors are retried until the deadline
+            screenshot = {'status': 'unknown'}
+
+        self._update(tracked, screenshot)
+
+    def _update(self, tracked, screenshot):
+        status = screenshot.get('status', '')
+
+        if status == 'finished' or status == 'error':
+            self._complete(tracked, screenshot, None)
+        elif time.time() >= tracked.deadline:
+            self._complete(tracked, None, BrowshotError('Screenshot %s not finished in time' % tracked.id))
+        else:
+            if status == 'processing':
+                tracked.interval = self.poll_interval
+            else:
+                tracked.interval = min(tracked.interval * self.backoff, self.max_poll_interval)
+
+            with self._condition:
+                self._push(tracked, time.time() + tracked.interval)
+
+    def _complete(self, tracked, screenshot, exception):
+        if exception is None:
+            tracked.future.set_result(screenshot)
+        else:
+            tracked.future.set_exception(exception)
+
+        # Queued before the screenshot stops being pending, so that completed() cannot miss it
+        self._completed.put(tracked.future)
+        with self._condition:
+            self._tracked.pop(tracked.id, None)
+
+        if self.callback is not None:
+            self.callback(tracked.future)
+
+
+class _Capture(object):
+    def __init__(self, url, parameters, file, thumbnail, timeout):
+        self.url = url
+        self.parameters = parameters
+        self.file = file
+        self.thumbnail = thumbnail
+        self.timeout = timeout
+        self.future = BrowshotFuture()
+
+
+class BrowshotCaptureEngine(object):
+    def __init__(self, client, workers=10, poll_interval=2, max_poll_interval=30, backoff=1.5, timeout=300):
+        """ Request screenshots and wait for them in the background. Each capture runs screenshot_create, then screenshot_info until the screenshot is finished or failed, and optionally screenshot_thumbnail_file:
+
+            engine = BrowshotCaptureEngine(client)
+            future = engine.capture('http://www.example.com/', file='/tmp/example.png')
+            ...
+            screenshot = future.result()
+
+        Captures waiting for the next screenshot_info are not using any thread, so thousands of captures can be in progress at the same time. See BrowshotTracker for how the screenshots are checked.
+
+        Arguments:
+            client: BrowshotClient object used to send the requests.
+            workers: maximum number of requests sent at the same time. 10 by default.
+            poll_interval: seconds to wait before the first screenshot_info. 2 seconds by default.
+            max_poll_interval: maximum number of seconds between two screenshot_info. 30 seconds by default.
+            backoff: the time between two screenshot_info is multiplied by this factor while the screenshot is in queue. 1.5 by default.
+            timeout: default maximum number of seconds to wait for a capture. 5 minutes by default.
+        """
+        self.client = client
+        self.timeout = timeout
+
+        self.pool = BrowshotWorkerPool(workers)
+        self.tracker = BrowshotTracker(client, poll_interval=poll_interval, max_poll_interval=max_poll_interval, backoff=backoff, timeout=timeout, pool=self.pool)
+
+    def capture(self, url='', parameters={}, file=None, thumbnail={}, timeout=None):
+        """ Request a screenshot and return a BrowshotFuture for the final screenshot_info reply. The future raises BrowshotError if the screenshot failed or was not finished in time.
+
+            Arguments:
+            See https://browshot.com/api/documentation#screenshot_create for the full list of possible arguments.
+                url (Required): URL of the website to create a screenshot of.
+                file: local file to save the screenshot to once it is finished. The path is added to the reply as 'file'.
+                thumbnail: arguments for screenshot_thumbnail_file, used if file is set. You get the full image by default.
+                timeout: maximum number of seconds to wait for the screenshot. Uses the engine timeout by default.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        capture = _Capture(url, dict(parameters), file, dict(thumbnail), timeout)
+        self.pool.submit(self._create, capture)
+        return capture.future
+
+    def pending(self):
+        """ Return the number of captures waiting for their screenshot to be finished. """
+        return self.tracker.pending()
+
+    def close(self):
+        """ Stop the engine. Captures still in progress are abandoned. """
+        self.tracker.close()
+        self.pool.shutdown(wait=False)
+
+    def _create(self, capture):
+        try:
+            screenshot = self.client.screenshot_create(capture.url, dict(capture.parameters))
+        except Exception, e:
+            capture.future.set_exception(e)
+            return
+
+        if not 'id' in screenshot:
+            capture.future.set_exception(BrowshotError(screenshot.get('error', 'Screenshot not created')))
+        elif screenshot.get('status') in ('finished', 'error'):
+            self._finish(capture, screenshot)
+        else:
+            tracked = self.tracker.add(screenshot['id'], capture.timeout)
+            tracked.add_done_callback(lambda future: self._tracked(capture, future))
+
+    def _tracked(self, capture, future):
+        if future.exception() is not None:
+            capture.future.set_exception(future.exception())
+        else:
+            self._finish(capture, future.result())
+
+    def _finish(self, capture, screenshot):
+        if screenshot.get('status') == 'error':
+            capture.future.set_exception(BrowshotError(screenshot.get('error', 'Screenshot failed')))
+            return
+
+        if capture.file is not None:
+            try:
+                self.client.screenshot_thumbnail_file(screenshot['id'], capture.file, dict(capture.thumbnail))
+                screenshot = dict(screenshot, file=capture.file)
+            except Exception, e:
+                capture.future.set_exception(e)
+                return
+
+        capture.future.set_result(screenshot)
+
+
+class _ByteBudget(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        size = min(size, self.max_bytes)
+        with self._condition:
+            while self.used + size > self.max_bytes:
+                self._condition.wait()
+            self.used += size
+        return size
+
+    def release(self, size):
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+class BrowshotDownloader(object):
+    def __init__(self, client, workers=10, max_bytes=16 * 1024 * 1024, retries=3, chunk_size=65536, progress=None):
+        """ Download many screenshots, or the archives of a batch, at the same time.
+
+            downloader = BrowshotDownloader(client, workers=20)
+            screenshots = downloader.download_screenshots(client.screenshot_multiple({'urls': urls, 'instances': instances}), '/tmp/screenshots/')
+
+        Arguments:
+            client: BrowshotClient object used to send the requests.
+            workers: maximum number of files downloaded at the same time. 10 by default.
+            max_bytes: maximum number of bytes received but not written to disk yet, for all the downloads. 16MB by default.
+            retries: number of times a failed download is tried again. 3 by default.
+            chunk_size: size of the chunks written to disk, in bytes. 64KB by default.
+            progress: function called as progress(done, total, result) after each file, successful or not.
+        """
+        self.client = client
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.progress = progress
+
+        self.pool = BrowshotWorkerPool(workers)
+        self._budget = _ByteBudget(max_bytes)
+        self._lock = threading.Lock()
+        self._state = {'done': 0, 'total': 0}
+
+    def download_screenshots(self, screenshots, directory, parameters={}, name='%(id)s.png', wait=True, timeout=300):
+        """ Save the images of screenshots to a directory. Return the list of screenshots, in the same order, each with 'file' set to the local file, or 'error' set if the download failed.
+
+            Arguments:
+                screenshots (Required): reply of screenshot_multiple or screenshot_list, or a list of screenshots
+                directory (Required): local directory to store the images
+                parameters: arguments for screenshot_thumbnail. You get the full image by default.
+                name: name of the files, formatted with the screenshot details. '<id>.png' by default.
+                wait: Set to False to skip the screenshots not finished yet instead of waiting for them. True by default.
+                timeout: maximum number of seconds to wait for the screenshots not finished yet. 5 minutes by default.
+        """
+        if isinstance(screenshots, dict):
+            screenshots = screenshots.values()
+        screenshots = [dict(screenshot) for screenshot in screenshots]
+
+        tracker = None
+        if wait and len([s for s in screenshots if s.get('status') not in ('finished', 'error')]) > 0:
+            tracker = BrowshotTracker(self.client, timeout=timeout, pool=self.pool)
+
+        state = {'done': 0, 'total': len(screenshots)}
+        futures = []
+        for screenshot in screenshots:
+            future = BrowshotFuture()
+            futures.append(future)
+            file = os.path.join(directory, name % screenshot)
+
+            if screenshot.get('status') == 'finished':
+                self.pool.submit(self._download_screenshot, screenshot, file, parameters, future, state)
+            elif tracker is not None and screenshot.get('status') != 'error' and 'id' in screenshot:
+                tracker.add(screenshot['id']).add_done_callback(
+                    lambda tracked, file=file, future=future: self._tracked(tracked, file, parameters, future, state))
+            else:
+                self._done(future, dict(screenshot, error=screenshot.get('error', 'Screenshot not finished')), state)
+
+        results = [future.result() for future in futures]
+        if tracker is not None:
+            tracker.close()
+
+        return results
+
+    def download_screenshot(self, screenshot={}, file='', parameters={}):
+        """ Save the image of a finished screenshot in the background. Return a BrowshotFuture for the screenshot, with 'file' set to the local file, or 'error' set if the download failed.
+
+            Arguments:
+                screenshot (Required): screenshot details, as returned by screenshot_info
+                file (Required): local file to store the image
+                parameters: arguments for screenshot_thumbnail. You get the full image by default.
+        """
+        with self._lock:
+            self._state['total'] += 1
+
+        future = BrowshotFuture()
+        self.pool.submit(self._download_screenshot, dict(screenshot), file, parameters, future, self._state)
+        return future
+
+    def download_batch(self, batch, directory):
+        """ Save the archives of a finished batch to a directory. Return the list of local files; BrowshotError is raised if an archive cannot be downloaded.
+
+            Arguments:
+                batch (Required): reply of batch_info
+                directory (Required): local directory to store the archives
+        """
+        urls = batch.get('urls', [])
+        state = {'done': 0, 'total': len(urls)}
+
+        futures = []
+        for url in urls:
+            file = os.path.join(directory, urllib.unquote(url.split('?')[0].rstrip('/').split('/')[-1]) or 'batch.zip')
+            future = BrowshotFuture()
+            futures.append(future)
+            self.pool.submit(self._download_url, url, file, future, state)
+
+        return [future.result() for future in futures]
+
+    def close(self):
+        """ Stop the download threads. """
+        self.pool.shutdown(wait=False)
+
+    def _tracked(self, tracked, file, parameters, future, state):
+        if tracked.exception() is not None:
+            self._done(future, {'error': str(tracked.exception())}, state)
+        elif tracked.result().get('status') != 'finished':
+            self._done(future, dict(tracked.result(), error=tracked.result().get('error', 'Screenshot failed')), state)
+        else:
+            self._download_screenshot(dict(tracked.result()), file, parameters, future, state)
+
+    def _download_screenshot(self, screenshot, file, parameters, future, state):
+        try:
+            self._save(lambda: self.client._stream('screenshot/thumbnail', dict(parameters, id=screenshot['id']), self.chunk_size), file)
+            screenshot['file'] = file
+        except Exception, e:
+            screenshot['error'] = str(e)
+
+        self._done(future, screenshot, state)
+
+    def _download_url(self, url, file, future, state):
+        try:
+            self._save(lambda: self.client.return_reply_stream(url, self.chunk_size), file)
+            self._done(future, file, state)
+        except Exception, e:
+            future.set_exception(e)
+
+    def _save(self, stream, file):
+        attempt = 0
+        while True:
+            try:
+                return _save_chunks(self._budgeted(iter(stream())), file)
+            except Exception, e:
+                if attempt >= self.retries or (isinstance(e, BrowshotError) and 400 <= e.code < 500):
+                    raise
+                attempt += 1
+                time.sleep(min(0.5 * 2 ** attempt, 10))
+
+    def _budgeted(self, chunks):
+        try:
+            while True:
+                size = self._budget.acquire(self.chunk_size)
+                try:
+                    chunk = next(chunks)
+                except:
+                    self._budget.release(size)
+                    raise
+
+                try:
+                    yield chunk
+                finally:
+                    self._budget.release(size)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def _done(self, future, result, state):
+        with self._lock:
+            state['done'] += 1
+            done = state['done']
+
+        if self.progress is not None:
+            self.progress(done, state['total'], result)
+        future.set_result(result)
+
+
+def _derive_thumbnail(source, file, arguments):
+    """ Create a thumbnail of the image source, with the arguments of screenshot_thumbnail, and save it to file. Run in the processes of BrowshotThumbnailer. """
+    image = Image.open(source)
+    image.load()
+
+    arguments = dict(arguments)
+    format = str(arguments.pop('format', '') or os.path.splitext(file)[1][1:] or 'png').upper()
+    if format == 'JPG':
+        format = 'JPEG'
+    quality = int(arguments.pop('quality', 90))
+    ratio = arguments.pop('ratio', 'fit')
+
+    left, top = int(arguments.pop('left', 0)), int(arguments.pop('top', 0))
+    right, bottom = int(arguments.pop('right', 0) or image.size[0]), int(arguments.pop('bottom', 0) or image.size[1])
+    if (left, top, right, bottom) != (0, 0) + image.size:
+        image = image.crop((left, top, min(right, image.size[0]), min(bottom, image.size[1])))
+
+    width, height = image.size
+    scale = float(arguments.pop('scale', 0) or 0)
+    target_width, target_height = int(arguments.pop('width', 0) or 0), int(arguments.pop('height', 0) or 0)
+    if len(arguments) > 0:
+        raise BrowshotError('Arguments not supported locally: %s' % ', '.join(sorted(arguments.keys())))
+
+    if scale > 0:
+        target_width, target_height = int(round(width * scale)), int(round(height * scale))
+    elif target_width > 0 and target_height == 0:
+        target_height = int(round(height * target_width / float(width)))
+    elif target_height > 0 and target_width == 0:
+        target_width = int(round(width * target_height / float(height)))
+
+    if target_width > 0 and target_height > 0 and (target_width, target_height) != (width, height):
+        if ratio == 'fill':
+            # Cover the whole thumbnail, then cut what goes beyond
+            factor = max(target_width / float(width), target_height / float(height))
+            image = image.resize((max(int(round(width * factor)), target_width), max(int(round(height * factor)), target_height)), Image.ANTIALIAS)
+            x, y = (image.size[0] - target_width) // 2, (image.size[1] - target_height) // 2
+            image = image.crop((x, y, x + target_width, y + target_height))
+        else:
+            factor = min(target_width / float(width), target_height / float(height))
+            image = image.resize((max(int(round(width * factor)), 1), max(int(round(height * factor)), 1)), Image.ANTIALIAS)
+
+    if format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file)), prefix='.browshot-')
+    try:
+        with os.fdopen(handle, 'wb') as output:
+            image.save(output, format, quality=quality)
+        os.rename(temporary, file)
+    except:
+        os.remove(temporary)
+        raise
+
+    return file
+
+
+class BrowshotThumbnailer(object):
+    def __init__(self, client, processes=None, local=True):
+        """ Create several thumbnails of a screenshot from a single download: the full image is retrieved once with screenshot_thumbnail, and the thumbnails are resized locally by a pool of processes:
+
+            thumbnailer = BrowshotThumbnailer(client)
+            thumbnailer.thumbnails(id, {'/tmp/small.png': {'width': 320}, '/tmp/square.jpg': {'width': 200, 'height': 200, 'ratio': 'fill'}})
+
+        The thumbnails that cannot be made locally, because PIL is not installed, the arguments are not supported locally or the image cannot be read, are requested from the API with screenshot_thumbnail_file.
+
+        Arguments:
+            client: BrowshotClient object used to send the requests.
+            processes: number of processes resizing the images. One per CPU by default.
+            local: Set to False to always request the thumbnails from the API. True by default.
+        """
+        self.client = client
+        self.processes = processes
+        self.local = local and Image is not None
+
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def thumbnails(self, id=0, thumbnails={}, parameters={}):
+        """ Create the thumbnails of a screenshot. Return {<file>: <file>} for the thumbnails created, and {<file>: <BrowshotError>} for the thumbnails that failed.
+
+            Arguments:
+                id (Required): screenshot ID.
+                thumbnails (Required): dictionary of local file => arguments of screenshot_thumbnail: width, height, scale, ratio (fit or fill), left, top, right, bottom (crop), format (png or jpeg) and quality. The format is taken from the file extension by default.
+                parameters: arguments for screenshot_thumbnail to retrieve the image resized locally. You get the full image by default.
+        """
+        results = {}
+        pending = {}
+
+        if self.local and len(thumbnails) > 0:
+            handle, source = tempfile.mkstemp(suffix='.png', prefix='.browshot-')
+            os.close(handle)
+            try:
+                self.client.screenshot_thumbnail_file(id, source, parameters)
+                pool = self.pool()
+                for file, arguments in thumbnails.items():
+                    pending[file] = pool.apply_async(_derive_thumbnail, (source, file, arguments))
+
+                for file, result in pending.items():
+                    try:
+                        results[file] = result.get()
+                    except Exception:
+                        pass
+            except Exception:
+                pass
+            finally:
+                os.remove(source)
+
+        # Fall back to the API
+        for file, arguments in thumbnails.items():
+            if file in results:
+                continue
+            try:
+                results[file] = self.client.screenshot_thumbnail_file(id, file, arguments)
+            except Exception, e:
+                results[file] = BrowshotError(str(e))
+
+        return results
+
+    def pool(self):
+        """ Return the pool of processes, started on first use. """
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.processes)
+            return self._pool
+
+    def close(self):
+        """ Stop the processes. """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+
+class _InstanceStats(object):
+    def __init__(self, latency):
+        self.latency = latency
+        self.failure_rate = 0.0
+        self.in_flight = 0
+
+
+class BrowshotScheduler(object):
+    def __init__(self, client, refresh=60, latency=30, cost_weight=1.0, smoothing=0.2, types=('private', 'shared', 'free')):
+        """ Send each screenshot_create to the instance expected to finish it first, using the load and cost reported by instance_list and the latency and failures observed on the screenshots already requested:
+
+            scheduler = BrowshotScheduler(client)
+            screenshot = scheduler.screenshot_create('http://www.example.com/', {'width': 1024})
+            ...
+            scheduler.observe(client.screenshot_info(screenshot['id']))
+
+        The expected completion time of an instance is its observed latency, multiplied by its load plus the screenshots sent to it and not finished yet, and divided by its success rate. It is multiplied by (1 + cost_weight * screenshot_cost) to favor the cheapest instances.
+
+        Arguments:
+            client: BrowshotClient object used to send the requests.
+            refresh: number of seconds between two instance_list. 60 seconds by default.
+            latency: expected number of seconds to finish a screenshot on an instance with no observed screenshot. 30 seconds by default.
+            cost_weight: weight of the instance cost, 0 to ignore the cost. 1 by default.
+            smoothing: weight of the last observation in the latency and failure rate averages. 0.2 by default.
+            types: instance types to use, among private, shared and free. All of them by default.
+        """
+        self.client = client
+        self.refresh = refresh
+        self.latency = latency
+        self.cost_weight = cost_weight
+        self.smoothing = smoothing
+        self.types = types
+
+        self._instances = []
+        self._updated = 0
+        self._stats = {}
+        self._submitted = {}
+        self._lock = threading.Lock()
+
+    def instances(self):
+        """ Return the list of instances that can be used, refreshing it with instance_list if needed. """
+        with self._lock:
+            if self._updated + self.refresh > time.time():
+                return self._instances
+
+        reply = self.client.instance_list()
+        if 'error' in reply:
+            raise BrowshotError(reply['error'])
+
+        instances = []
+        for type in self.types:
+            instances.extend(reply.get(type, []))
+
+        with self._lock:
+            self._instances = instances
+            self._updated = time.time()
+
+        return instances
+
+    def choose(self, width=None, height=None, browser=None, mobile=None):
+        """ Return the instance expected to finish a screenshot first, or None if no instance matches.
+
+            Arguments:
+                width: minimum screen width
+                height: minimum screen height
+                browser: browser name, or part of the name
+                mobile: Set to True for a mobile browser, False for a desktop browser. Any browser by default.
+        """
+        best = None
+        for instance in self.instances():
+            if width is not None and int(instance.get('width', 0)) < int(width):
+                continue
+            if height is not None and int(instance.get('height', 0)) < int(height):
+                continue
+
+            details = instance.get('browser', {})
+            if browser is not None and not browser.lower() in str(details.get('name', '')).lower():
+                continue
+            if mobile is not None and bool(int(details.get('mobile', 0))) != bool(mobile):
+                continue
+
+            score = self.predict(instance)
+            if best is None or score < best[0]:
+                best = (score, instance)
+
+        if best is None:
+            return None
+        return best[1]
+
+    def predict(self, instance):
+        """ Return the expected number of seconds to finish a screenshot on an instance, weighted by its cost. """
+        with self._lock:
+            stats = self._stats.get(instance['id'])
+            latency, failure_rate, in_flight = self.latency, 0.0, 0
+            if stats is not None:
+                latency, failure_rate, in_flight = stats.latency, stats.failure_rate, stats.in_flight
+
+        load = float(instance.get('load', 0) or 0)
+        cost = float(instance.get('screenshot_cost', 0) or 0)
+
+        return latency * (1 + load + in_flight) / max(1 - failure_rate, 0.05) * (1 + self.cost_weight * cost)
+
+    def screenshot_create(self, url='', parameters={}):
+        """ Request a screenshot on the best instance, unless instance_id is set. See BrowshotClient.screenshot_create. BrowshotError is raised if no instance matches the width, height, browser and mobile arguments.
+
+            Arguments:
+            See https://browshot.com/api/documentation#screenshot_create for the full list of possible arguments.
+                url (Required): URL of the website to create a screenshot of.
+                width, height, browser, mobile: requirements for the instance, see choose(). They are not sent to the API, except width and height.
+        """
+        parameters = dict(parameters)
+        browser = parameters.pop('browser', None)
+        mobile = parameters.pop('mobile', None)
+
+        if not 'instance_id' in parameters:
+            instance = self.choose(parameters.get('width'), parameters.get('height'), browser, mobile)
+            if instance is None:
+                raise BrowshotError('No instance available for this screenshot')
+            parameters['instance_id'] = instance['id']
+
+        instance_id = parameters['instance_id']
+        screenshot = self.client.screenshot_create(url, parameters)
+
+        if 'id' in screenshot:
+            with self._lock:
+                self._submitted[screenshot['id']] = (instance_id, time.time())
+                self._instance_stats(instance_id).in_flight += 1
+            self.observe(screenshot)
+
+        return screenshot
+
+    def observe(self, screenshot={}):
+        """ Update the latency and failure rate of the instance with the reply of screenshot_info for a screenshot requested through the scheduler. Ignored for screenshots not finished yet or not requested through the scheduler. """
+        if not screenshot.get('status') in ('finished', 'error'):
+            return
+
+        with self._lock:
+            submitted = self._submitted.pop(screenshot.get('id'), None)
+            if submitted is None:
+                return
+
+            instance_id, start = submitted
+            stats = self._instance_stats(instance_id)
+            stats.in_flight -= 1
+
+            failed = screenshot['status'] == 'error'
+            stats.failure_rate += self.smoothing * ((1.0 if failed else 0.0) - stats.failure_rate)
+            if not failed:
+                stats.latency += self.smoothing * ((time.time() - start) - stats.latency)
+
+    def stats(self):
+        """ Return a dictionary of instance ID => {'latency': <seconds>, 'failure_rate': <rate>, 'in_flight': <screenshots not finished>} for the instances used so far. """
+        with self._lock:
+            return dict((id, {'latency': stats.latency, 'failure_rate': stats.failure_rate, 'in_flight': stats.in_flight}) for id, stats in self._stats.items())
+
+    def _instance_stats(self, instance_id):
+        if not instance_id in self._stats:
+            self._stats[instance_id] = _InstanceStats(self.latency)
+        return self._stats[instance_id]
+
+
+class _ChunkReader(object):
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+
+    def read(self, size):
+        parts = [self.buffer]
+        available = len(self.buffer)
+        while available < size:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                break
+            parts.append(chunk)
+            available += len(chunk)
+
+        data = ''.join(parts)
+        self.buffer = data[size:]
+        return data[:size]
+
+    def read_some(self):
+        if self.buffer != '':
+            data, self.buffer = self.buffer, ''
+            return data
+        return next(self.chunks, '')
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+
+def _zip_entries(chunks):
+    """ Return an iterator over the (name, content) of the files of a ZIP archive, parsing the archive as its chunks are received. """
+    reader = _ChunkReader(chunks)
+
+    while True:
+        header = reader.read(30)
+        if len(header) < 30 or header[:4] != 'PK\x03\x04':
+            # End of the files, the central directory is not needed
+            return
+
+        signature, version, flags, method, modified_time, modified_date, crc, compressed_size, size, name_length, extra_length = struct.unpack('<IHHHHHIIIHH', header)
+        name = reader.read(name_length)
+        reader.read(extra_length)
+
+        if not method in (0, 8):
+            raise BrowshotError('Unsupported compression method %d for %s' % (method, name))
+        if compressed_size == 0xFFFFFFFF:
+            raise BrowshotError('ZIP64 archives are not supported')
+
+        if flags & 0x08:
+            # Sizes are only known after the content, which must be deflated to find its end
+            if method != 8:
+                raise BrowshotError('Stored entry with a data descriptor: %s' % name)
+
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            parts = []
+            while True:
+                data = reader.read_some()
+                if data == '':
+                    raise BrowshotError('Truncated archive')
+                parts.append(decompressor.decompress(data))
+                if decompressor.unused_data != '':
+                    reader.unread(decompressor.unused_data)
+                    break
+            content = ''.join(parts) + decompressor.flush()
+
+            descriptor = reader.read(4)
+            if descriptor == 'PK\x07\x08':
+                descriptor = reader.read(4)
+            crc = struct.unpack('<I', descriptor)[0]
+            reader.read(8)
+        else:
+            content = reader.read(compressed_size)
+            if len(content) < compressed_size:
+                raise BrowshotError('Truncated archive')
+            if method == 8:
+                content = zlib.decompress(content, -zlib.MAX_WBITS)
+
+        if zlib.crc32(content) & 0xFFFFFFFF != crc:
+            raise BrowshotError('Corrupted file in archive: %s' % name)
+
+        if not name.endswith('/'):
+            yield (name, content)
+
+
+class BrowshotBatchReader(object):
+    def __init__(self, client, retries=3, chunk_size=65536):
+        """ Read the screenshots of a finished batch while its archives are downloaded:
+
+            reader = BrowshotBatchReader(client)
+            for name, content in reader.entries(client.batch_info(id), '/tmp/batch/'):
+                ...
+
+        Archives are parsed as they are received, so the first screenshots are available before the download is complete. If the connection is lost, the download resumes where it stopped with an HTTP range request, including after a restart when the archives are kept in a directory.
+
+        Arguments:
+            client: BrowshotClient object used to send the requests.
+            retries: number of times a download is resumed after an error. 3 by default.
+            chunk_size: size of the chunks read from the network, in bytes. 64KB by default.
+        """
+        self.client = client
+        self.retries = retries
+        self.chunk_size = chunk_size
+
+    def entries(self, batch={}, directory=None, prefetch=0):
+        """ Return an iterator over the (file name, content) of the screenshots of a batch.
+
+            Arguments:
+                batch (Required): reply of batch_info
+                directory: local directory to keep the archives. Partial downloads are kept as <name>.part and resumed. The archives are not stored by default.
+                prefetch: number of screenshots read ahead in a background thread, so that downloading continues while the screenshots are processed. Disabled by default.
+        """
+        if prefetch <= 0:
+            return self._entries(batch, directory)
+        return self._prefetch(self._entries(batch, directory), prefetch)
+
+    def extract(self, batch={}, directory='', archives=None):
+        """ Save the screenshots of a batch to a directory, as they are downloaded. Return the list of files.
+
+            Arguments:
+                batch (Required): reply of batch_info
+                directory (Required): local directory to store the screenshots
+                archives: local directory to keep the archives, see entries(). The archives are not stored by default.
+        """
+        files = []
+        for name, content in self.entries(batch, archives):
+            file = os.path.join(directory, os.path.basename(name))
+            _save_chunks([content], file)
+            files.append(file)
+
+        return files
+
+    def _entries(self, batch, directory):
+        for url in batch.get('urls', []):
+            part = None
+            if directory is not None:
+                name = urllib.unquote(url.split('?')[0].rstrip('/').split('/')[-1]) or 'batch.zip'
+                part = os.path.join(directory, name + '.part')
+
+            for entry in _zip_entries(self._download(url, part)):
+                yield entry
+
+            if part is not None and os.path.exists(part):
+                os.rename(part, part[:-len('.part')])
+
+    def _download(self, url, part):
+        offset = 0
+        if part is not None and os.path.exists(part):
+            offset = os.path.getsize(part)
+
+        attempt = 0
+        while True:
+            headers = None
+            if offset > 0:
+                headers = {'Range': 'bytes=%d-' % offset}
+
+            response = None
+            try:
+                response = self.client.send_request('GET', url, stream=True, headers=headers)
+                if response.status_code == 416:
+                    # Already complete
+                    if part is not None:
+                        for chunk in self._read_part(part):
+                            yield chunk
+                    return
+                if response.status_code >= 400:
+                    raise BrowshotError('HTTP error %d' % response.status_code, response.status_code)
+
+                if offset > 0 and response.status_code != 206:
+                    if attempt > 0:
+                        raise BrowshotError('The download of %s cannot be resumed' % url)
+
+                    # The range was ignored: start again
+                    offset = 0
+                    if part is not None:
+                        os.remove(part)
+
+                if attempt == 0 and part is not None and offset > 0:
+                    for chunk in self._read_part(part):
+                        yield chunk
+
+                output = None
+                if part is not None:
+                    output = open(part, 'ab')
+                try:
+                    for chunk in response.iter_content(self.chunk_size):
+                        if output is not None:
+                            output.write(chunk)
+                        offset += len(chunk)
+                        yield chunk
+                finally:
+                    if output is not None:
+                        output.close()
+                return
+            except (requests.RequestException, IOError), e:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                time.sleep(min(2 ** attempt, 30))
+            finally:
+                if response is not None:
+                    response.close()
+
+    def _read_part(self, part):
+        with open(part, 'rb') as handle:
+            while True:
+                chunk = handle.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _prefetch(self, entries, size):
+        queue = Queue.Queue(size)
+
+        def produce():
+            try:
+                for entry in entries:
+                    queue.put((entry, None))
+            except Exception, e:
+                queue.put((None, e))
+                return
+            queue.put((None, None))
+
+        thread = threading.Thread(target=produce, name='browshot-batch')
+        thread.daemon = True
+        thread.start()
+
+        while True:
+            entry, error = queue.get()
+            if error is not None:
+                raise error
+            if entry is None:
+                return
+            yield entry
+
+
+class BrowshotCrawlWatcher(object):
+    def __init__(self, client, poll_interval=5, max_poll_interval=60, backoff=1.5):
+        """ Follow the progress of a crawl. crawl_info is called until the crawl is finished, and only the changes since the previous call are reported:
+
+            watcher = BrowshotCrawlWatcher(client)
+            for event in watcher.events(crawl['id']):
+                if event['event'] == 'finished':
+                    ...
+
+        The time between two crawl_info is reset when the crawl changes, and grows while it does not. Replies identical to the previous one are not decoded.
+
+        Arguments:
+            client: BrowshotClient object used to send the requests.
+            poll_interval: minimum number of seconds between two crawl_info. 5 seconds by default.
+            max_poll_interval: maximum number of seconds between two crawl_info. 60 seconds by default.
+            backoff: the time between two crawl_info is multiplied by this factor when nothing changed. 1.5 by default.
+        """
+        self.client = client
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+
+    def events(self, id=0, timeout=None):
+        """ Return an iterator over the changes of a crawl, as dictionaries:
+                {'event': 'discovered', 'screenshot': <screenshot>}: a new page was found
+                {'event': 'finished', 'screenshot': <screenshot>}: the screenshot of a page is finished
+                {'event': 'error', 'screenshot': <screenshot>}: the screenshot of a page failed
+                {'event': 'done', 'crawl': <crawl>}: the crawl is finished, this is the last event
+
+            Arguments:
+                id (Required): crawl ID
+                timeout: maximum number of seconds to follow the crawl, after which BrowshotError is raised. No limit by default.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        statuses = {}
+        previous = None
+        interval = self.poll_interval
+
+        while True:
+            content = self.client.return_reply_string('crawl/info', {'id': id})
+            changed = False
+
+            if content != previous:
+                previous = content
+                crawl = self.client.decoder(content)
+                if 'error' in crawl and not 'screenshots' in crawl:
+                    raise BrowshotError(crawl['error'])
+
+                screenshots = crawl.pop('screenshots', []) or []
+                pending = 0
+                for screenshot in screenshots:
+                    status = screenshot.get('status', '')
+                    known = statuses.get(screenshot['id'])
+                    if status == known:
+                        if not status in ('finished', 'error'):
+                            pending += 1
+                        continue
+
+                    changed = True
+                    statuses[screenshot['id']] = status
+                    if known is None:
+                        yield {'event': 'discovered', 'screenshot': screenshot}
+                    if status in ('finished', 'error'):
+                        yield {'event': status, 'screenshot': screenshot}
+                    else:
+                        pending += 1
+
+                if crawl.get('status') in ('finished', 'error') and pending == 0:
+                    yield {'event': 'done', 'crawl': crawl}
+                    return
+
+            if changed:
+                interval = self.poll_interval
+            else:
+                interval = min(interval * self.backoff, self.max_poll_interval)
+
+            if deadline is not None:
+                if time.time() >= deadline:
+                    raise BrowshotError('Crawl %s not finished in time' % id)
+                interval = min(interval, deadline - time.time())
+            time.sleep(max(interval, 0))
+
+    def download(self, id=0, directory='', downloader=None, parameters={}, name='%(id)s.png', timeout=None):
+        """ Save the screenshots of a crawl to a directory as soon as each of them is finished. Return the list of screenshots, each with 'file' set to the local file, or 'error' set if the screenshot or its download failed.
+
+            Arguments:
+                id (Required): crawl ID
+                directory (Required): local directory to store the images
+                downloader: BrowshotDownloader object used to download the screenshots concurrently. A new BrowshotDownloader with the default settings is used by default.
+                parameters: arguments for screenshot_thumbnail. You get the full image by default.
+                name: name of the files, formatted with the screenshot details. '<id>.png' by default.
+                timeout: maximum number of seconds to follow the crawl. No limit by default.
+        """
+        own = downloader is None
+        if own:
+            downloader = BrowshotDownloader(self.client)
+
+        try:
+            futures = []
+            for event in self.events(id, timeout):
+                screenshot = event.get('screenshot')
+                if event['event'] == 'finished':
+                    futures.append(downloader.download_screenshot(screenshot, os.path.join(directory, name % screenshot), parameters))
+                elif event['event'] == 'error':
+                    futures.append(BrowshotFuture())
+                    futures[-1].set_result(dict(screenshot, error=screenshot.get('error', 'Screenshot failed')))
+
+            return [future.result() for future in futures]
+        finally:
+            if own:
+                downloader.close()
+
+
+class _HookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_hook('')
+
+    def do_POST(self):
+        self.handle_hook(self.rfile.read(int(self.headers.get('Content-Length', 0) or 0)))
+
+    def handle_hook(self, body):
+        url = urlparse.urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        receiver = self.server.receiver
+
+        if len(parts) != 2 or not _same(parts[0], receiver.token):
+            return self.reply(403, 'Invalid token')
+        if not parts[1] in receiver.KINDS:
+            return self.reply(404, 'Unknown notification')
+
+        notification = dict((key, values[-1]) for key, values in urlparse.parse_qs(url.query).items())
+        if body != '':
+            try:
+                if 'json' in self.headers.get('Content-Type', 'application/json'):
+                    notification.update(simplejson.loads(body))
+                else:
+                    notification.update((key, values[-1]) for key, values in urlparse.parse_qs(body).items())
+            except (ValueError, TypeError):
+                return self.reply(400, 'Invalid notification')
+
+        try:
+            id = int(notification.get('id'))
+        except (ValueError, TypeError):
+            return self.reply(400, 'Missing or invalid ID')
+
+        receiver.notify(parts[1], id, notification)
+        self.reply(200, 'OK')
+
+    def reply(self, code, message):
+        content = simplejson.dumps({'status': 'ok' if code == 200 else 'error', 'message': message})
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def _same(a, b):
+    """ Compare two strings in constant time. """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+class _HookServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class BrowshotHookReceiver(object):
+    KINDS = ('screenshot', 'batch', 'crawl')
+
+    def __init__(self, client, host='0.0.0.0', port=0, public_url=None, token=None, hook_timeout=120, poll_interval=60, timeout=3600, verify=False):
+        """ HTTP server receiving the notifications sent by Browshot when a screenshot, a batch or a crawl is done, instead of polling screenshot_info, batch_info or crawl_info:
+
+            receiver = BrowshotHookReceiver(client, port=8080, public_url='http://my.server.com:8080/')
+            future = receiver.screenshot_create('http://www.example.com/')
+            ...
+            screenshot = future.result()
+
+        The hook URLs contain a random token: notifications sent to any other URL are rejected. A screenshot, batch or crawl that has not been notified <hook_timeout> seconds after it was requested is checked with the API every <poll_interval> seconds instead.
+
+        Arguments:
+            client: BrowshotClient object used to send the requests.
+            host: address to listen to. All the addresses by default.
+            port: port to listen to. A free port is chosen by default, see receiver.port.
+            public_url: URL under which the receiver can be reached by the Browshot servers. http://<host>:<port>/ by default.
+            token: secret part of the hook URLs. A random token is generated by default.
+            hook_timeout: seconds to wait for a notification before checking with the API. 2 minutes by default.
+            poll_interval: seconds between two checks with the API once hook_timeout is over. 60 seconds by default.
+            timeout: maximum number of seconds to wait, after which the future raises BrowshotError. 1 hour by default.
+            verify: Set to True to confirm each notification with screenshot_info, batch_info or crawl_info before using it. By default, the notification is used as the reply.
+        """
+        self.client = client
+        self.token = token or hashlib.sha1(os.urandom(32)).hexdigest()
+        self.hook_timeout = hook_timeout
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.verify = verify
+
+        self._pending = {}
+        self._queue = []
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self.server = _HookServer((host, port), _HookHandler)
+        self.server.receiver = self
+        self.port = self.server.server_address[1]
+        self.public_url = public_url or 'http://%s:%d/' % (host if host != '0.0.0.0' else 'localhost', self.port)
+
+        self._threads = [threading.Thread(target=self.server.serve_forever, name='browshot-hooks'), threading.Thread(target=self._poll, name='browshot-hooks-poll')]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def hook_url(self, kind='screenshot'):
+        """ Return the URL to pass as the hook argument for a screenshot, a batch or a crawl. """
+        return '%s%s/%s' % (self.public_url.rstrip('/') + '/', self.token, kind)
+
+    def watch(self, kind='screenshot', id=0, timeout=None):
+        """ Return a BrowshotFuture for the notification of a screenshot, batch or crawl requested with the hook URL of this receiver. The result is the notification, in the format of screenshot_info, batch_info or crawl_info, with the status finished or error.
+
+            Arguments:
+                kind (Required): 'screenshot', 'batch' or 'crawl'
+                id (Required): ID of the screenshot, batch or crawl
+                timeout: maximum number of seconds to wait. Uses the receiver timeout by default.
+        """
+        if not kind in self.KINDS:
+            raise BrowshotError('Unknown kind %s' % kind)
+        if timeout is None:
+            timeout = self.timeout
+
+        key = (kind, int(id))
+        with self._condition:
+            if key in self._pending:
+                return self._pending[key][0]
+
+            future = BrowshotFuture()
+            self._pending[key] = (future, time.time() + timeout)
+            heapq.heappush(self._queue, (time.time() + min(self.hook_timeout, timeout), key))
+            self._condition.notify()
+        return future
+
+    def screenshot_create(self, url='', parameters={}):
+        """ Request a screenshot with the hook argument set, and return a BrowshotFuture for its notification. See BrowshotClient.screenshot_create. """
+        return self._create('screenshot', self.client.screenshot_create(url, dict(parameters, hook=self.hook_url('screenshot'))))
+
+    def batch_create(self, file='', parameters={}):
+        """ Request a batch with the hook argument set, and return a BrowshotFuture for its notification. See BrowshotClient.batch_create. """
+        return self._create('batch', self.client.batch_create(file, dict(parameters, hook=self.hook_url('batch'))))
+
+    def crawl_create(self, domain='', url='', parameters={}):
+        """ Request a crawl with the hook argument set, and return a BrowshotFuture for its notification. See BrowshotClient.crawl_create. """
+        return self._create('crawl', self.client.crawl_create(domain, url, dict(parameters, hook=self.hook_url('crawl'))))
+
+    def pending(self):
+        """ Return the number of screenshots, batches and crawls not notified yet. """
+        with self._condition:
+            return len(self._pending)
+
+    def close(self):
+        """ Stop the server. The futures not resolved yet are abandoned. """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def notify(self, kind='screenshot', id=0, notification=None):
+        """ Resolve the future of a screenshot, batch or crawl. Called by the server for each valid notification. Notifications for unknown IDs, or with a status other than finished and error, are ignored. """
+        with self._condition:
+            if not (kind, id) in self._pending:
+                return
+
+        if self.verify:
+            try:
+                notification = self._info(kind, id)
+            except Exception:
+                return
+
+        if notification.get('status') in ('finished', 'error'):
+            self._resolve(kind, id, self.client.return_typed(kind + '/info', notification))
+
+    def _create(self, kind, reply):
+        if not 'id' in reply:
+            future = BrowshotFuture()
+            future.set_exception(BrowshotError(reply.get('error', '%s not created' % kind.capitalize())))
+            return future
+        if reply.get('status') in ('finished', 'error'):
+            future = BrowshotFuture()
+            future.set_result(reply)
+            return future
+        return self.watch(kind, reply['id'])
+
+    def _info(self, kind, id):
+        return getattr(self.client, kind + '_info')(id, {})
+
+    def _resolve(self, kind, id, reply=None, error=None):
+        with self._condition:
+            entry = self._pending.pop((kind, id), None)
+        if entry is None:
+            return
+        if error is not None:
+            entry[0].set_exception(error)
+        else:
+            entry[0].set_result(reply)
+
+    def _poll(self):
+        while True:
+            with self._condition:
+                while not self._closed and (len(self._queue) == 0 or self._queue[0][0] > time.time()):
+                    self._condition.wait(self._queue[0][0] - time.time() if self._queue else None)
+                if self._closed:
+                    return
+
+                due, key = heapq.heappop(self._queue)
+                if not key in self._pending:
+                    continue
+                deadline = self._pending[key][1]
+
+            kind, id = key
+            try:
+                reply = self._info(kind, id)
+            except Exception:
+                reply = {}
+
+            if reply.get('status') in ('finished', 'error'):
+                self._resolve(kind, id, reply)
+            elif time.time() >= deadline:
+                self._resolve(kind, id, error=BrowshotError('%s %s not done in time' % (kind.capitalize(), id)))
+            else:
+                with self._condition:
+                    heapq.heappush(self._queue, (min(time.time() + self.poll_interval, deadline), key))
+
+
+def _cli_parameters(values):
+    parameters = {}
+    for value in values:
+        if not '=' in value:
+            raise argparse.ArgumentTypeError('%s is not NAME=VALUE' % value)
+        name, value = value.split('=', 1)
+        parameters[name] = value
+    return parameters
+
+
+def _cli_worker(options, tasks, results):
+    """ Capture the URLs of one shard: read (url, id) from tasks until None, and send the progress to results. """
+    journal = BrowshotJournal(os.path.join(options.output, 'journal.sqlite'))
+    client = BrowshotClient(options.key, base=options.base, transport=BrowshotTransport(pool_size=options.concurrency),
+                            retry_policy=BrowshotRetryPolicy(circuit_breaker=False), journal=journal)
+    pool = BrowshotWorkerPool(options.concurrency)
+    tracker = BrowshotTracker(client, poll_interval=options.poll_interval, timeout=options.timeout, pool=pool)
+    slots = threading.Semaphore(options.in_flight)
+    parameters = _cli_parameters(options.argument)
+    thumbnail = _cli_parameters(options.thumbnail)
+
+    def finish(url, entry):
+        entry['url'] = url
+        results.put(('done', entry))
+        slots.release()
+
+    def create(url):
+        try:
+            # The journal returns the screenshot already requested for this URL, if any
+            screenshot = client.screenshot_create(url, parameters)
+            if not 'id' in screenshot:
+                return finish(url, {'status': 'error', 'error': screenshot.get('error', 'Screenshot not created')})
+
+            id = screenshot['id']
+            tracker.add(id, options.timeout).add_done_callback(lambda future: pool.submit(download, url, id, future))
+        except Exception, e:
+            finish(url, {'status': 'error', 'error': str(e)})
+
+    def download(url, id, future):
+        entry = {'id': id, 'status': 'error'}
+        try:
+            screenshot = future.result()
+            if screenshot.get('status') != 'finished':
+                entry['error'] = screenshot.get('error', 'Screenshot failed')
+            else:
+                file = client.screenshot_thumbnail_file(id, os.path.join(options.output, '%s.png' % id), thumbnail)
+                entry.update({'status': 'finished', 'file': file, 'size': os.path.getsize(file)})
+        except Exception, e:
+            entry['error'] = str(e)
+        finish(url, entry)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slots.acquire()
+        pool.submit(create, task)
+
+    # Wait for the captures in progress
+    for i in range(options.in_flight):
+        slots.acquire()
+
+    tracker.close()
+    pool.shutdown()
+    client.close()
+    journal.close()
+    results.put(('exit', None))
+
+
+def _cli_feed(input, journal, builder, parameters, tasks, counters):
+    try:
+        for line in input:
+            url = line.strip()
+            if url == '':
+                continue
+
+            # Skip the screenshots already saved, or failed, in a previous run
+            screenshot = journal.submission('screenshot/create', builder.request_key('screenshot/create', dict(parameters, url=url)))
+            if screenshot is not None:
+                job = journal.job('screenshot', screenshot['id'])
+                if job is not None and (job['file'] is not None or job['status'] == 'error'):
+                    counters['skipped'] += 1
+                    continue
+
+            tasks[counters['queued'] % len(tasks)].put(url)
+            counters['queued'] += 1
+    finally:
+        for queue in tasks:
+            queue.put(None)
+
+
+def main(arguments=None):
+    """ Command line: python -m browshot --help """
+    parser = argparse.ArgumentParser(prog='python -m browshot', description='Take screenshots of a list of URLs. The images, a manifest of the screenshots (manifest.jsonl) and a journal (journal.sqlite) are written to the output directory. Run the same command again to resume an interrupted run: the URLs already captured are skipped, and the screenshots already requested are not requested again.')
+    parser.add_argument('input', nargs='?', default='-', help='file with one URL per line. URLs are read from the standard input by default.')
+    parser.add_argument('-k', '--key', default=os.environ.get('BROWSHOT_KEY', ''), help='API key. $BROWSHOT_KEY by default.')
+    parser.add_argument('-o', '--output', default='.', help='directory for the images, the manifest and the journal. Current directory by default.')
+    parser.add_argument('-p', '--processes', type=int, default=multiprocessing.cpu_count(), help='number of processes. One per CPU by default.')
+    parser.add_argument('-c', '--concurrency', type=int, default=10, help='requests sent at the same time by each process. 10 by default.')
+    parser.add_argument('-n', '--in-flight', type=int, default=100, help='screenshots in progress at the same time in each process. 100 by default.')
+    parser.add_argument('-a', '--argument', action='append', default=[], metavar='NAME=VALUE', help='argument for screenshot_create, e.g. -a instance_id=12. Can be repeated.')
+    parser.add_argument('-t', '--thumbnail', action='append', default=[], metavar='NAME=VALUE', help='argument for screenshot_thumbnail, e.g. -t width=640. The full image is saved by default.')
+    parser.add_argument('--timeout', type=float, default=300, help='maximum number of seconds to wait for a screenshot. 5 minutes by default.')
+    parser.add_argument('--poll-interval', type=float, default=2, help='seconds to wait before the first screenshot_info. 2 seconds by default.')
+    parser.add_argument('--stats-interval', type=float, default=10, help='seconds between two progress lines on the standard error. 0 to disable. 10 seconds by default.')
+    parser.add_argument('--base', default='https://api.browshot.com/api/v1/', help=argparse.SUPPRESS)
+    options = parser.parse_args(arguments)
+
+    try:
+        _cli_parameters(options.argument + options.thumbnail)
+    except argparse.ArgumentTypeError, e:
+        parser.error(str(e))
+
+    if not os.path.isdir(options.output):
+        os.makedirs(options.output)
+
+    journal = BrowshotJournal(os.path.join(options.output, 'journal.sqlite'))
+    manifest = open(os.path.join(options.output, 'manifest.jsonl'), 'a')
+    input = sys.stdin
+    if options.input != '-':
+        input = open(options.input)
+
+    tasks = [multiprocessing.Queue(options.in_flight * 2) for i in range(max(options.processes, 1))]
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_cli_worker, args=(options, queue, results)) for queue in tasks]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    counters = {'queued': 0, 'skipped': 0, 'finished': 0, 'error': 0, 'bytes': 0}
+    feeder = threading.Thread(target=_cli_feed, args=(input, journal, BrowshotRequestBuilder(options.base, options.key), _cli_parameters(options.argument), tasks, counters))
+    feeder.daemon = True
+    feeder.start()
+
+    start = time.time()
+    reported = start
+
+    def report():
+        elapsed = max(time.time() - start, 0.001)
+        done = counters['finished'] + counters['error']
+        line = '%d finished, %d failed, %d skipped, %d queued, %.1f screenshots/s, %.2f MB/s, %.0f seconds' % (counters['finished'], counters['error'], counters['skipped'],
+               counters['queued'] - done, done / elapsed, counters['bytes'] / elapsed / 1024 / 1024, elapsed)
+        sys.stderr.write(line + '\n')
+
+    running = len(workers)
+    while running > 0:
+        try:
+            kind, entry = results.get(True, 1)
+        except Queue.Empty:
+            if not [worker for worker in workers if worker.is_alive()]:
+                break
+            kind = None
+
+        if kind == 'exit':
+            running -= 1
+        elif kind == 'done':
+            manifest.write(simplejson.dumps(entry) + '\n')
+            counters[entry['status']] += 1
+            counters['bytes'] += entry.get('size', 0)
+
+        if options.stats_interval > 0 and time.time() - reported >= options.stats_interval:
+            reported = time.time()
+            report()
+
+    for worker in workers:
+        worker.join()
+
+    manifest.close()
+    journal.close()
+    if input is not sys.stdin:
+        input.close()
+    report()
+
+    return 1 if counters['error'] > 0 else 0
+
+
 if __name__ == "__main__":
-    client = BrowshotClient()
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) Julien Sobrier
+#
+# This file is part of printio released under MIT license.
+# See the LICENSE for more information.
+"""
+
+Measure the overhead of the library against a local stand-in for the Browshot API.
+
+    python tests/benchmark.py --requests 2000 --threads 8 --image-size 5000000
+
+Each scenario runs in its own process, so that the peak RSS reported is its own.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing
+
+libpath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if not libpath in sys.path:
+    sys.path.insert(1, libpath)
+del libpath
+
+from browshot import BrowshotClient, BrowshotTransport
+from mock_server import MockBrowshotServer
+
+
+def percentile(values, percent):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100.0), len(values) - 1)]
+
+
+def scenario_info(client, i, directory):
+    client.screenshot_info(1, {})
+
+PREPARED = {}
+
+def scenario_info_prepared(client, i, directory):
+    if not client in PREPARED:
+        PREPARED[client] = client.prepare('screenshot/info')
+    PREPARED[client].reply(1)
+
+def scenario_multiple_urls(client, i, directory):
+    client.make_url('screenshot/multiple', {'urls': ['http://example.com/%d' % n for n in range(500)], 'instances': [12, 65]})
+
+def scenario_thumbnail_memory(client, i, directory):
+    return len(client.screenshot_thumbnail(1, {}))
+
+def scenario_thumbnail_stream(client, i, directory):
+    file = os.path.join(directory, '%d.png' % i)
+    client.screenshot_thumbnail_file(1, file, {})
+    size = os.path.getsize(file)
+    os.remove(file)
+    return size
+
+def scenario_simple_stream(client, i, directory):
+    file = os.path.join(directory, '%d.png' % i)
+    client.simple_file('http://example.com/', file, {})
+    size = os.path.getsize(file)
+    os.remove(file)
+    return size
+
+
+SCENARIOS = [
+    ('info, new connection',     scenario_info,                False),
+    ('info, pooled',             scenario_info,                True),
+    ('info, prepared',           scenario_info_prepared,       True),
+    ('make_url, 500 URLs',       scenario_multiple_urls,       True),
+    ('thumbnail, in memory',     scenario_thumbnail_memory,    True),
+    ('thumbnail, streamed',      scenario_thumbnail_stream,    True),
+    ('simple, streamed',         scenario_simple_stream,       True),
+]
+
+
+def run(base, function, keep_alive, requests, threads, results):
+    transport = BrowshotTransport(pool_size=threads, keep_alive=keep_alive)
+    client = BrowshotClient('key', base=base, transport=transport)
+    directory = tempfile.mkdtemp()
+
+    latencies = []
+    sizes = []
+    lock = threading.Lock()
+    counter = [0]
+
+    def worker():
+        while True:
+            with lock:
+                if counter[0] >= requests:
+                    return
+                counter[0] += 1
+                i = counter[0]
+
+            start = time.time()
+            size = function(client, i, directory) or 0
+            elapsed = time.time() - start
+
+            with lock:
+                latencies.append(elapsed)
+                sizes.append(size)
+
+    start = time.time()
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+
+    shutil.rmtree(directory)
+    client.close()
+
+    results.put({
+        'requests/s': len(latencies) / elapsed,
+        'p50 ms': percentile(latencies, 50) * 1000,
+        'p99 ms': percentile(latencies, 99) * 1000,
+        'MB/s': sum(sizes) / elapsed / 1024 / 1024,
+        'peak RSS MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark browshot.py against a local stand-in server.')
+    parser.add_argument('--requests', type=int, default=1000, help='requests per scenario')
+    parser.add_argument('--threads', type=int, default=4, help='concurrent requests')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added by the server to each reply')
+    parser.add_argument('--image-size', type=int, default=1000000, help='size of the images in bytes')
+    parser.add_argument('--scenario', action='append', help='run only the scenarios containing this text')
+    arguments = parser.parse_args()
+
+    server = MockBrowshotServer(latency=arguments.latency, image_size=arguments.image_size)
+    server.create('http://example.com/', 12)
+
+    columns = ['requests/s', 'p50 ms', 'p99 ms', 'MB/s', 'peak RSS MB']
+    print '%-24s' % 'scenario' + ''.join('%14s' % column for column in columns) + '%14s' % 'connections'
+
+    for name, function, keep_alive in SCENARIOS:
+        if arguments.scenario and not [text for text in arguments.scenario if text in name]:
+            continue
+
+        connections = server.counters['connections']
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run, args=(server.base, function, keep_alive, arguments.requests, arguments.threads, results))
+        process.start()
+        result = results.get()
+        process.join()
+
+        print '%-24s' % name + ''.join('%14.1f' % result[column] for column in columns) + '%14d' % (server.counters['connections'] - connections)
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -13,7 +13,16 @@ Test the library.
 
 import os
 import sys
+import zlib
+import struct
+import shutil
+import tempfile
+import StringIO
+import threading
+import time
 import unittest
+import requests
+import simplejson
 #import datetime
 
 libpath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -22,7 +31,17 @@ if not libpath in sys.path:
     print libpath
 del libpath
 
-from browshot import BrowshotClient
+from browshot import BrowshotClient, BrowshotTransport, AsyncBrowshotClient, BrowshotFuture, BrowshotError, BrowshotCaptureEngine, BrowshotTracker, BrowshotDownloader, BrowshotMetadataCache, BrowshotScreenshotCache, BrowshotScheduler, BrowshotRateLimiter, BrowshotCreditGovernor, BrowshotRetryPolicy, BrowshotCircuitBreaker, BrowshotBatchReader, BrowshotCrawlWatcher
+from browshot import BrowshotResult, BrowshotScreenshot, BrowshotInstance, BrowshotBrowser, BrowshotBatch, BrowshotCrawl
+from browshot import BrowshotRequestBuilder, BrowshotPreparedRequest, BrowshotMetrics, BrowshotCoalescer, BrowshotThumbnailer, BrowshotHookReceiver, BrowshotJournal
+from browshot import _zip_entries, _json_object_items, _redact
+import browshot
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+from mock_server import MockBrowshotServer
 
 
 
@@ -438,6 +457,1084 @@ class BrowshotClient_ParseTestCase(unittest.TestCase):
 
         self.assertEquals(True, 'error' in account)
 
+class FakeResponse(object):
+    def __init__(self, content='', status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTransport(object):
+    """ Transport that answers from a dictionary of action => content instead of sending requests. """
+    def __init__(self, replies=None):
+        self.replies = replies or {}
+        self.requests = []
+
+    def reply(self, url):
+        action = url.split('/api/v1/')[1].split('?')[0]
+        reply = self.replies.get(action, '{}')
+        if callable(reply):
+            reply = reply(url)
+        if isinstance(reply, FakeResponse):
+            return reply
+        return FakeResponse(reply)
+
+    def get(self, url, stream=False, headers=None):
+        self.requests.append(('GET', url))
+        return self.reply(url)
+
+    def post(self, url, data=None, files=None, headers=None):
+        self.requests.append(('POST', url))
+        return self.reply(url)
+
+    def close(self):
+        pass
+
+
+class BrowshotClient_TransportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport({
+            'instance/list': '{"free": [], "shared": [], "private": []}',
+            'screenshot/thumbnail': '\x89PNG',
+            'simple': '\x89PNG',
+        })
+        self.client = BrowshotClient('key', transport=self.transport)
+
+    def test_all_paths_use_transport(self):
+        self.assertEquals([], self.client.instance_list()['free'])
+        self.assertEquals('\x89PNG', self.client.screenshot_thumbnail(1, {}))
+        self.assertEquals(200, self.client.simple('http://example.com/', {})['code'])
+        self.assertEquals(3, len(self.transport.requests))
+
+    def test_simple_error(self):
+        self.transport.replies['simple'] = FakeResponse('', 404)
+        data = self.client.simple('http://example.com/', {})
+        self.assertEquals(404, data['code'])
+        self.assertEquals('',  data['png'])
+
+    def test_shared_transport(self):
+        transport = BrowshotTransport(pool_size=4, timeout=5)
+        client1 = BrowshotClient('key', transport=transport)
+        client2 = BrowshotClient('key', transport=transport)
+        self.assertEquals(True, client1.transport is client2.transport)
+
+        adapter = transport.session.get_adapter('https://api.browshot.com/')
+        self.assertEquals(4, adapter._pool_maxsize)
+        transport.close()
+
+class AsyncBrowshotClient_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport({
+            'screenshot/info': lambda url: '{"id": %s, "status": "finished"}' % url.split('id=')[1],
+            'screenshot/create': '{"error": "Missing URL"}',
+        })
+        self.client = AsyncBrowshotClient('key', transport=self.transport, concurrency=4)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_screenshot_info(self):
+        futures = [self.client.screenshot_info(i) for i in range(1, 50)]
+        for i, future in enumerate(futures):
+            self.assertEquals(i + 1, future.result(5)['id'])
+
+    def test_callback(self):
+        results = []
+        future = self.client.screenshot_create()
+        future.result(5)
+        future.add_done_callback(lambda f: results.append(f.result()))
+        self.assertEquals(True, 'error' in results[0])
+
+    def test_future_timeout(self):
+        future = BrowshotFuture()
+        self.assertRaises(BrowshotError, future.result, 0.01)
+        future.set_exception(ValueError())
+        self.assertRaises(ValueError, future.result)
+
+class BrowshotClient_StreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.image = '\x89PNG' + 'x' * 100000
+        self.transport = FakeTransport({
+            'screenshot/thumbnail': self.image,
+            'simple': self.image,
+        })
+        self.client = BrowshotClient('key', transport=self.transport)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_simple_file(self):
+        file = os.path.join(self.directory, 'simple.png')
+        data = self.client.simple_file('http://example.com/', file, {})
+        self.assertEquals(200,  data['code'])
+        self.assertEquals(file, data['file'])
+        self.assertEquals(self.image, open(file, 'rb').read())
+        self.assertEquals(['simple.png'], os.listdir(self.directory))
+
+    def test_simple_file_wrong_size(self):
+        file = os.path.join(self.directory, 'simple.png')
+        data = self.client.simple_file('http://example.com/', file, {}, expected_size=10)
+        self.assertEquals('', data['file'])
+        self.assertEquals([], os.listdir(self.directory))
+
+    def test_thumbnail_iter(self):
+        chunks = list(self.client.screenshot_thumbnail_iter(1, {}, chunk_size=4096))
+        self.assertEquals(True, len(chunks) > 1)
+        self.assertEquals(self.image, ''.join(chunks))
+
+    def test_thumbnail_file_error(self):
+        self.transport.replies['screenshot/thumbnail'] = FakeResponse('', 404)
+        file = os.path.join(self.directory, 'thumbnail.png')
+        self.assertRaises(BrowshotError, self.client.screenshot_thumbnail_file, 1, file, {})
+        self.assertEquals(False, os.path.exists(file))
+
+class BrowshotCaptureEngine_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.statuses = ['in_queue', 'processing', 'finished']
+        self.transport = FakeTransport({
+            'screenshot/create': '{"id": 5, "status": "in_queue"}',
+            'screenshot/info': lambda url: '{"id": 5, "status": "%s"}' % self.statuses.pop(0),
+            'screenshot/thumbnail': '\x89PNG',
+        })
+        self.client = BrowshotClient('key', transport=self.transport)
+        self.engine = BrowshotCaptureEngine(self.client, workers=2, poll_interval=0.01, timeout=5)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.engine.close()
+        shutil.rmtree(self.directory)
+
+    def test_capture(self):
+        file = os.path.join(self.directory, 'capture.png')
+        screenshot = self.engine.capture('http://example.com/', file=file).result(5)
+        self.assertEquals('finished', screenshot['status'])
+        self.assertEquals(file, screenshot['file'])
+        self.assertEquals('\x89PNG', open(file, 'rb').read())
+        self.assertEquals(0, len(self.statuses))
+
+    def test_capture_cached(self):
+        self.transport.replies['screenshot/create'] = '{"id": 5, "status": "finished"}'
+        screenshot = self.engine.capture('http://example.com/').result(5)
+        self.assertEquals('finished', screenshot['status'])
+        self.assertEquals(1, len(self.transport.requests))
+
+    def test_capture_error(self):
+        self.statuses = ['error']
+        future = self.engine.capture('http://example.com/')
+        self.assertRaises(BrowshotError, future.result, 5)
+
+    def test_capture_timeout(self):
+        self.statuses = ['processing'] * 1000
+        future = self.engine.capture('http://example.com/', timeout=0.1)
+        self.assertRaises(BrowshotError, future.result, 5)
+        self.assertEquals(True, future.done())
+
+class BrowshotTracker_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport({
+            'screenshot/info': lambda url: '{"id": %s, "status": "finished"}' % url.split('id=')[1],
+            'screenshot/list': '{"1": {"id": 1, "status": "finished"}, "2": {"id": 2, "status": "error"}, "3": {"id": 3, "status": "processing"}}',
+        })
+        self.client = BrowshotClient('key', transport=self.transport)
+
+    def test_poll(self):
+        tracker = BrowshotTracker(self.client, workers=2, poll_interval=0.01, sweep_threshold=0)
+        for id in range(1, 6):
+            tracker.add(id)
+
+        ids = sorted([future.result()['id'] for future in tracker.completed(5)])
+        self.assertEquals([1, 2, 3, 4, 5], ids)
+        self.assertEquals(0, tracker.pending())
+        tracker.close()
+
+    def test_sweep(self):
+        tracker = BrowshotTracker(self.client, workers=2, poll_interval=0.01, sweep_threshold=3)
+        for id in range(1, 6):
+            tracker.add(id)
+
+        screenshots = dict((future.result()['id'], future.result()['status']) for future in tracker.completed(5))
+        self.assertEquals({1: 'finished', 2: 'error', 3: 'finished', 4: 'finished', 5: 'finished'}, screenshots)
+
+        actions = [url.split('/api/v1/')[1].split('?')[0] for method, url in self.transport.requests]
+        self.assertEquals(1, actions.count('screenshot/list'))
+        self.assertEquals(3, actions.count('screenshot/info'))
+        tracker.close()
+
+class BrowshotDownloader_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport({
+            'screenshot/info': lambda url: '{"id": %s, "status": "finished"}' % url.split('id=')[1],
+            'screenshot/thumbnail': lambda url: FakeResponse('', 404) if 'id=3&' in url + '&' else FakeResponse('\x89PNG' + url.split('id=')[1]),
+            'batch/1.zip': 'PK',
+        })
+        self.client = BrowshotClient('key', transport=self.transport)
+        self.directory = tempfile.mkdtemp()
+        self.progress = []
+        self.downloader = BrowshotDownloader(self.client, workers=3, max_bytes=10, retries=0, progress=lambda done, total, result: self.progress.append((done, total)))
+
+    def tearDown(self):
+        self.downloader.close()
+        shutil.rmtree(self.directory)
+
+    def test_download_screenshots(self):
+        screenshots = [{'id': 1, 'status': 'finished'}, {'id': 2, 'status': 'in_queue'}, {'id': 3, 'status': 'finished'}, {'id': 4, 'status': 'error'}]
+        results = self.downloader.download_screenshots(screenshots, self.directory)
+
+        self.assertEquals([1, 2, 3, 4], [result['id'] for result in results])
+        self.assertEquals(os.path.join(self.directory, '1.png'), results[0]['file'])
+        self.assertEquals('\x89PNG2', open(results[1]['file'], 'rb').read())
+        self.assertEquals(True, 'error' in results[2])
+        self.assertEquals(True, 'error' in results[3])
+        self.assertEquals(['1.png', '2.png'], sorted(os.listdir(self.directory)))
+        self.assertEquals((4, 4), max(self.progress))
+
+    def test_download_batch(self):
+        files = self.downloader.download_batch({'id': 1, 'status': 'finished', 'urls': ['https://api.browshot.com/api/v1/batch/1.zip']}, self.directory)
+        self.assertEquals([os.path.join(self.directory, '1.zip')], files)
+        self.assertEquals('PK', open(files[0], 'rb').read())
+
+class BrowshotMetadataCache_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport({
+            'instance/list': '{"free": [{"id": 12}], "shared": [], "private": []}',
+            'instance/info': lambda url: '{"id": %s}' % url.split('id=')[1],
+            'browser/info': '{"error": "Invalid browser ID"}',
+        })
+        self.cache = BrowshotMetadataCache(max_entries=2)
+        self.client = BrowshotClient('key', transport=self.transport, metadata_cache=self.cache)
+
+    def test_instance_list(self):
+        instances = self.client.instance_list()
+        instances['free'].pop()
+        self.assertEquals(12, self.client.instance_list()['free'][0]['id'])
+        self.assertEquals(1, len(self.transport.requests))
+        self.assertEquals({'hits': 1, 'misses': 1, 'entries': 1}, self.cache.stats())
+
+        self.cache.invalidate('instance/list')
+        self.client.instance_list()
+        self.assertEquals(2, len(self.transport.requests))
+
+    def test_lru(self):
+        self.client.instance_info(1)
+        self.client.instance_info(2)
+        self.client.instance_info(1)
+        self.client.instance_info(3)
+        self.assertEquals(3, len(self.transport.requests))
+
+        self.client.instance_info(2)
+        self.assertEquals(4, len(self.transport.requests))
+
+        self.cache.invalidate(id=2)
+        self.assertEquals(1, self.cache.stats()['entries'])
+
+    def test_no_error(self):
+        self.client.browser_info(0)
+        self.client.browser_info(0)
+        self.client.account_info({})
+        self.client.account_info({})
+        self.assertEquals(4, len(self.transport.requests))
+
+    def test_expired(self):
+        self.cache.ttl['instance/list'] = 0
+        self.client.instance_list()
+        time.sleep(0.01)
+        self.client.instance_list()
+        self.assertEquals(2, len(self.transport.requests))
+
+class BrowshotScreenshotCache_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.transport = FakeTransport({
+            'screenshot/thumbnail': lambda url: '\x89PNG' + 'x' * 1000 + url.split('id=')[1].split('&')[0],
+            'simple': lambda url: FakeResponse('', 304) if self.not_modified else FakeResponse('\x89PNG', headers={'ETag': '"1"'}),
+        })
+        self.not_modified = False
+        self.cache = BrowshotScreenshotCache(os.path.join(self.directory, 'cache'), max_size=2500)
+        self.client = BrowshotClient('key', transport=self.transport, screenshot_cache=self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_thumbnail(self):
+        thumbnail = self.client.screenshot_thumbnail(1, {})
+        self.assertEquals(thumbnail, self.client.screenshot_thumbnail(1, {}))
+        file = os.path.join(self.directory, '1.png')
+        self.client.screenshot_thumbnail_file(1, file, {})
+        self.assertEquals(thumbnail, open(file, 'rb').read())
+
+        self.assertEquals(1, len(self.transport.requests))
+        self.assertEquals(2, self.cache.stats()['hits'])
+
+    def test_eviction(self):
+        for id in (1, 2, 1, 3):
+            self.client.screenshot_thumbnail(id, {})
+        self.assertEquals(2, self.cache.stats()['entries'])
+
+        self.client.screenshot_thumbnail(1, {})
+        self.assertEquals(3, len(self.transport.requests))
+        self.client.screenshot_thumbnail(2, {})
+        self.assertEquals(4, len(self.transport.requests))
+
+        # Reopen the cache
+        cache = BrowshotScreenshotCache(os.path.join(self.directory, 'cache'), max_size=2500)
+        self.assertEquals(2, cache.stats()['entries'])
+
+    def test_simple_revalidate(self):
+        self.assertEquals('\x89PNG', self.client.simple('http://example.com/', {})['png'])
+        self.assertEquals('\x89PNG', self.client.simple('http://example.com/', {})['png'])
+        self.assertEquals(1, len(self.transport.requests))
+
+        self.client.simple('http://example.com/', {'cache': 0})
+        self.not_modified = True
+        data = self.client.simple('http://example.com/', {'cache': 0})
+        self.assertEquals('\x89PNG', data['png'])
+        self.assertEquals(3, len(self.transport.requests))
+
+class BrowshotScheduler_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport({
+            'instance/list': """{
+                "free":    [{"id": 12, "width": 1024, "height": 768, "load": 2, "screenshot_cost": 0, "browser": {"name": "Firefox", "mobile": 0}}],
+                "shared":  [{"id": 24, "width": 1280, "height": 1024, "load": 0, "screenshot_cost": 1, "browser": {"name": "Chrome", "mobile": 0}}],
+                "private": [{"id": 65, "width": 1280, "height": 1024, "load": 0, "screenshot_cost": 1, "browser": {"name": "Chrome", "mobile": 0}},
+                            {"id": 66, "width": 320, "height": 480, "load": 0, "screenshot_cost": 1, "browser": {"name": "iPhone", "mobile": 1}}]
+            }""",
+            'screenshot/create': lambda url: '{"id": %d, "status": "in_queue"}' % len(self.transport.requests),
+        })
+        self.client = BrowshotClient('key', transport=self.transport)
+        self.scheduler = BrowshotScheduler(self.client)
+
+    def test_choose(self):
+        self.assertEquals(65, self.scheduler.choose()['id'])
+        self.assertEquals(12, self.scheduler.choose(browser='firefox')['id'])
+        self.assertEquals(65, self.scheduler.choose(width=1280)['id'])
+        self.assertEquals(66, self.scheduler.choose(mobile=True)['id'])
+        self.assertEquals(None, self.scheduler.choose(browser='Opera'))
+        self.assertEquals(1, len(self.transport.requests))
+
+    def test_spread(self):
+        instances = []
+        for i in range(4):
+            screenshot = self.scheduler.screenshot_create('http://example.com/', {'width': 1280})
+            instances.append(int(self.transport.requests[-1][1].split('instance_id=')[1].split('&')[0]))
+        self.assertEquals([24, 24, 65, 65], sorted(instances))
+
+        self.scheduler.observe({'id': screenshot['id'], 'status': 'error'})
+        stats = self.scheduler.stats()
+        self.assertEquals(3, stats[24]['in_flight'] + stats[65]['in_flight'])
+        self.assertEquals(True, max(stats[24]['failure_rate'], stats[65]['failure_rate']) > 0)
+
+class BrowshotClient_MockServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = MockBrowshotServer(image_size=100000)
+        self.client = BrowshotClient('key', base=self.server.base, transport=BrowshotTransport(pool_size=2))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_keep_alive(self):
+        screenshot = self.client.screenshot_create('http://example.com/', {})
+        for i in range(20):
+            self.assertEquals('finished', self.client.screenshot_info(screenshot['id'], {})['status'])
+            self.assertEquals(100000, len(self.client.screenshot_thumbnail(screenshot['id'], {})))
+
+        self.assertEquals(41, self.server.counters['requests'])
+        self.assertEquals(1, self.server.counters['connections'])
+
+    def test_simple(self):
+        self.assertEquals(200, self.client.simple('http://example.com/', {})['code'])
+        self.assertEquals(400, self.client.simple('', {})['code'])
+
+    def test_batch_create(self):
+        directory = tempfile.mkdtemp()
+        file = os.path.join(directory, 'urls.txt')
+        with open(file, 'w') as handle:
+            handle.write('http://example.com/\nhttp://example.org/\n')
+
+        self.assertEquals(2, self.client.batch_create(file, {})['count'])
+        self.assertEquals(3, self.client.batch_create(('http://example.com/%d' % i for i in range(3)), {})['count'])
+        self.assertEquals(2, self.client.batch_create(open(file), {}, compress=True)['count'])
+        self.assertEquals(['http://example.com/', 'http://example.org/'], self.server.uploads[-1])
+        shutil.rmtree(directory)
+
+    def test_batch_reader(self):
+        batch = self.client.batch_info(self.client.batch_create(['http://example.com/'], {})['id'], {})
+        reader = BrowshotBatchReader(self.client, chunk_size=1000)
+
+        entries = list(reader.entries(batch, prefetch=2))
+        self.assertEquals(['1.png', '2.png', '3.png'], [name for name, content in entries])
+        self.assertEquals(self.server.image, entries[2][1])
+
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, '1.zip.part'), 'wb') as handle:
+            handle.write(self.server.archive[:len(self.server.archive) / 2])
+        files = reader.extract(batch, directory, directory)
+        self.assertEquals(3, len(files))
+        self.assertEquals(self.server.image, open(files[0], 'rb').read())
+        self.assertEquals(self.server.archive, open(os.path.join(directory, '1.zip'), 'rb').read())
+        shutil.rmtree(directory)
+
+    def test_screenshot_list_iter(self):
+        for i in range(250):
+            self.server.create('http://example.com/%d' % i, 12)
+
+        for prefetch in (True, False):
+            requests = self.server.counters['requests']
+            ids = [screenshot['id'] for screenshot in self.client.screenshot_list_iter({}, page_size=100, prefetch=prefetch)]
+            self.assertEquals(range(1, 251), sorted(ids))
+            self.assertEquals(3, self.server.counters['requests'] - requests)
+
+        self.assertEquals(250, len(list(self.client.screenshot_search_iter('example.com', {}, page_size=100))))
+
+    def test_batch_create_many(self):
+        batches = self.client.batch_create_many(('http://example.com/%d' % i for i in range(25000)), {}, batch_size=10000)
+        self.assertEquals([10000, 10000, 5000], [batch['count'] for batch in batches])
+        self.assertEquals('http://example.com/24999', self.server.uploads[-1][-1])
+
+class BrowshotRateLimiter_TestCase(unittest.TestCase):
+    def test_rate(self):
+        limiter = BrowshotRateLimiter(rate=100, burst=5)
+        start = time.time()
+        for i in range(15):
+            limiter.acquire()
+        self.assertEquals(True, time.time() - start >= 0.09)
+
+    def test_shared(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'limit')
+        limiter1 = BrowshotRateLimiter(rate=100, burst=5, path=path)
+        limiter2 = BrowshotRateLimiter(rate=100, burst=5, path=path)
+
+        start = time.time()
+        for i in range(10):
+            limiter1.acquire()
+            limiter2.acquire()
+        self.assertEquals(True, time.time() - start >= 0.14)
+        shutil.rmtree(directory)
+
+
+class BrowshotCreditGovernor_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport({
+            'account/info': lambda url: '{"balance": %d, "active": 1}' % self.balance,
+            'instance/list': '{"free": [{"id": 12, "screenshot_cost": 0}], "shared": [], "private": [{"id": 65, "screenshot_cost": 1}]}',
+            'screenshot/create': lambda url: '{"error": "Invalid URL"}' if 'url=-' in url else '{"id": 1, "status": "in_queue"}',
+            'screenshot/multiple': '{"1": {"id": 1}, "2": {"id": 2}}',
+        })
+        self.balance = 3
+        self.client = BrowshotClient('key', transport=self.transport)
+        self.client.credit_governor = BrowshotCreditGovernor(self.client, max_wait=0.05, poll_interval=0.01)
+
+    def test_reserve(self):
+        self.client.screenshot_create('http://example.com/', {'instance_id': 65})
+        self.client.screenshot_create('-', {'instance_id': 65})
+        self.client.screenshot_create('http://example.com/', {'instance_id': 12})
+        self.client.screenshot_multiple({'urls': ['http://example.com/', 'http://example.org/'], 'instances': [65]})
+        self.assertEquals(0, self.client.credit_governor.balance)
+        self.assertEquals(0, self.client.credit_governor.reserved)
+
+        self.balance = 0
+        self.assertRaises(BrowshotError, self.client.screenshot_create, 'http://example.com/', {'instance_id': 65})
+        self.assertEquals(0, self.client.credit_governor.reserved)
+
+class BrowshotRetryPolicy_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.failures = []
+        self.transport = FakeTransport({
+            'instance/list': self.reply,
+            'screenshot/create': self.reply,
+        })
+        self.client = BrowshotClient('key', transport=self.transport, retry_policy=BrowshotRetryPolicy(retries=3, backoff=0))
+
+    def reply(self, url):
+        if len(self.failures) > 0:
+            failure = self.failures.pop(0)
+            if isinstance(failure, Exception):
+                raise failure
+            return FakeResponse('{"error": "Server error"}', failure)
+        return '{"id": 1}'
+
+    def test_safe_retry(self):
+        self.failures = [503, requests.exceptions.ReadTimeout(), 500]
+        self.assertEquals(1, self.client.instance_list()['id'])
+        self.assertEquals(4, len(self.transport.requests))
+
+    def test_charged_no_retry(self):
+        self.failures = [503]
+        self.assertEquals(True, 'error' in self.client.screenshot_create('http://example.com/', {}))
+
+        self.failures = [requests.exceptions.ReadTimeout()]
+        self.assertRaises(requests.exceptions.ReadTimeout, self.client.screenshot_create, 'http://example.com/', {})
+        self.assertEquals(2, len(self.transport.requests))
+
+    def test_charged_retry(self):
+        refused = requests.packages.urllib3.exceptions.NewConnectionError(None, 'Connection refused')
+        self.failures = [requests.ConnectionError(requests.packages.urllib3.exceptions.MaxRetryError(None, '/', refused)), 429]
+        self.assertEquals(1, self.client.screenshot_create('http://example.com/', {})['id'])
+        self.assertEquals(3, len(self.transport.requests))
+
+    def test_circuit_breaker(self):
+        breaker = BrowshotCircuitBreaker(failures=2, reset_timeout=0.05)
+        self.client.retry_policy = BrowshotRetryPolicy(retries=0, circuit_breaker=breaker)
+        self.failures = [500, 500]
+        self.client.instance_list()
+        self.client.instance_list()
+        self.assertEquals('open', breaker.state)
+
+        self.assertRaises(BrowshotError, self.client.instance_list)
+        self.assertEquals(2, len(self.transport.requests))
+
+        time.sleep(0.06)
+        self.client.instance_list()
+        self.assertEquals('closed', breaker.state)
+
+class ZipEntries_TestCase(unittest.TestCase):
+    def test_data_descriptor(self):
+        content = 'PNG' * 1000
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress(content) + compressor.flush()
+        crc = zlib.crc32(content) & 0xFFFFFFFF
+
+        entry = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0x08, 8, 0, 0, 0, 0, 0, 5, 0) + '1.png' + data
+        entry += struct.pack('<IIII', 0x08074b50, crc, len(data), len(content))
+        archive = entry + entry.replace('1.png', '2.png') + 'PK\x01\x02'
+
+        chunks = [archive[i:i + 7] for i in range(0, len(archive), 7)]
+        self.assertEquals([('1.png', content), ('2.png', content)], list(_zip_entries(chunks)))
+
+    def test_corrupted(self):
+        entry = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0, 0, 0, 0, 1234, 3, 3, 5, 0) + '1.png' + 'PNG'
+        self.assertRaises(BrowshotError, list, _zip_entries([entry]))
+
+class BrowshotCrawlWatcher_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.replies = [
+            {'id': 1, 'status': 'processing', 'screenshots': [{'id': 10, 'status': 'in_queue'}]},
+            {'id': 1, 'status': 'processing', 'screenshots': [{'id': 10, 'status': 'in_queue'}]},
+            {'id': 1, 'status': 'processing', 'screenshots': [{'id': 10, 'status': 'finished'}, {'id': 11, 'status': 'processing'}]},
+            {'id': 1, 'status': 'finished', 'screenshots': [{'id': 10, 'status': 'finished'}, {'id': 11, 'status': 'error'}]},
+        ]
+        self.transport = FakeTransport({
+            'crawl/info': lambda url: simplejson.dumps(self.replies.pop(0)),
+            'screenshot/thumbnail': '\x89PNG',
+        })
+        self.client = BrowshotClient('key', transport=self.transport)
+        self.watcher = BrowshotCrawlWatcher(self.client, poll_interval=0.01)
+
+    def test_events(self):
+        events = [(event['event'], event.get('screenshot', {}).get('id')) for event in self.watcher.events(1, timeout=5)]
+        self.assertEquals([('discovered', 10), ('finished', 10), ('discovered', 11), ('error', 11), ('done', None)], events)
+
+    def test_download(self):
+        directory = tempfile.mkdtemp()
+        screenshots = self.watcher.download(1, directory, timeout=5)
+        self.assertEquals(os.path.join(directory, '10.png'), screenshots[0]['file'])
+        self.assertEquals(True, 'error' in screenshots[1])
+        shutil.rmtree(directory)
+
+class JsonObjectItems_TestCase(unittest.TestCase):
+    def test_items(self):
+        data = simplejson.dumps({'1': {'id': 1, 'status': 'finished', 'url': 'http://example.com/{"},'}, '22': 12345, '3': [1, {'a': None}], '4': 'x'})
+        for size in (1, 3, 1000):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            self.assertEquals(simplejson.loads(data), dict(_json_object_items(chunks)))
+
+    def test_empty(self):
+        self.assertEquals([], list(_json_object_items(['[', ' ]'])))
+        self.assertEquals([], list(_json_object_items(['{}'])))
+        self.assertRaises(BrowshotError, list, _json_object_items(['<html>']))
+
+
+class BrowshotResult_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.transport = FakeTransport({
+            'screenshot/info': '{"id": "5", "status": "finished", "width": "1024", "scale": "0.5"}',
+            'screenshot/list': '{"5": {"id": 5, "status": "finished"}, "6": {"id": 6, "status": "error"}}',
+            'instance/list': '{"free": [{"id": "12", "load": "0.5", "browser": {"id": 1, "mobile": "1"}}], "shared": [], "private": []}',
+            'crawl/info': '{"id": 1, "status": "finished", "screenshots": [{"id": "7", "width": 800}]}',
+            'batch/info': '{"error": "Invalid batch ID", "status": "error"}',
+            'account/info': '{"balance": 10}',
+        })
+        self.client = BrowshotClient('key', transport=self.transport, typed=True)
+
+    def test_attributes(self):
+        screenshot = self.client.screenshot_info(5, {})
+        self.assertEquals(True, isinstance(screenshot, BrowshotScreenshot))
+        self.assertEquals(5, screenshot.id)
+        self.assertEquals(1024, screenshot.width)
+        self.assertEquals(0.5, screenshot.scale)
+        self.assertEquals('finished', screenshot.status)
+        self.assertRaises(AttributeError, getattr, screenshot, 'final_url')
+        self.assertRaises(AttributeError, setattr, screenshot, 'width', 1)
+
+        instance = self.client.instance_list()['free'][0]
+        self.assertEquals(12, instance.id)
+        self.assertEquals(0.5, instance.load)
+        self.assertEquals(True, isinstance(instance.browser, BrowshotBrowser))
+        self.assertEquals(True, instance.browser.mobile)
+
+        crawl = self.client.crawl_info(1, {})
+        self.assertEquals(7, crawl.screenshots[0].id)
+
+    def test_dictionary(self):
+        screenshot = self.client.screenshot_info(5, {})
+        self.assertEquals('1024', screenshot['width'])
+        self.assertEquals(None, screenshot.get('final_url'))
+        self.assertEquals(False, 'error' in screenshot)
+        self.assertEquals(screenshot.to_dict(), dict(screenshot))
+
+        screenshots = self.client.screenshot_list({})
+        self.assertEquals([5, 6], sorted(screenshot.id for screenshot in screenshots.values()))
+
+        batch = self.client.batch_info(1, {})
+        self.assertEquals(True, isinstance(batch, BrowshotBatch))
+        self.assertEquals('Invalid batch ID', batch['error'])
+        self.assertEquals({'balance': 10}, self.client.account_info({}))
+
+    def test_decoder(self):
+        calls = []
+        def decoder(content):
+            calls.append(content)
+            return simplejson.loads(content)
+
+        client = BrowshotClient('key', transport=self.transport, decoder=decoder)
+        self.assertEquals({'balance': 10}, client.account_info({}))
+        self.assertEquals(['{"balance": 10}'], calls)
+
+
+class BrowshotRequestBuilder_TestCase(unittest.TestCase):
+    def test_url(self):
+        builder = BrowshotRequestBuilder('https://api.browshot.com/api/v1/', 'a b')
+        self.assertEquals('https://api.browshot.com/api/v1/screenshot/info?key=a+b', builder.url('screenshot/info', {}))
+        self.assertEquals('https://api.browshot.com/api/v1/screenshot/multiple?key=a+b&url=http%3A%2F%2Fa%2F&url=http%3A%2F%2Fb%2F',
+                          builder.url('screenshot/multiple', {'urls': ['http://a/', 'http://b/']}))
+        self.assertEquals('instance_id=12&instance_id=65', builder.query({'instances': [12, 65]}))
+
+    def test_post(self):
+        builder = BrowshotRequestBuilder('https://api.browshot.com/api/v1/', 'key', max_url_length=100)
+        self.assertEquals('GET', builder.request('screenshot/info', {'id': 1})[0])
+
+        method, url, body = builder.request('screenshot/multiple', {'urls': ['http://example.com/%d' % i for i in range(10)]})
+        self.assertEquals('POST', method)
+        self.assertEquals('https://api.browshot.com/api/v1/screenshot/multiple?key=key', url)
+        self.assertEquals(10, body.count('url='))
+
+    def test_key_change(self):
+        client = BrowshotClient('key1')
+        client.key = 'key2'
+        self.assertEquals(True, client.make_url('account/info', {}).endswith('?key=key2'))
+
+    def test_mock_server(self):
+        server = MockBrowshotServer()
+        client = BrowshotClient('key', base=server.base)
+        client.request_builder.max_url_length = 200
+
+        screenshots = client.screenshot_multiple({'urls': ['http://example.com/%d' % i for i in range(20)], 'instances': [12]})
+        self.assertEquals(20, len(screenshots))
+
+        info = client.prepare('screenshot/info', {'id': 0, 'details': 1})
+        self.assertEquals(True, isinstance(info, BrowshotPreparedRequest))
+        for id in (1, 5, 20):
+            self.assertEquals(id, info.reply(id)['id'])
+        self.assertEquals('Invalid screenshot ID', info.reply(100)['error'])
+        self.assertEquals(10000, len(''.join(client.prepare('screenshot/thumbnail').stream(3))))
+
+        client.close()
+        server.stop()
+
+
+class BrowshotClient_ThreadsTestCase(unittest.TestCase):
+    def test_parameters_not_modified(self):
+        client = BrowshotClient('key', transport=FakeTransport())
+        parameters = {'instance_id': 12}
+        client.screenshot_create('http://example.com/', parameters)
+        client.screenshot_info(1, parameters)
+        self.assertEquals({'instance_id': 12}, parameters)
+
+        client.screenshot_info(1)
+        self.assertEquals(True, client.make_url('screenshot/create').endswith('?key=key'))
+
+    def test_shared_client(self):
+        server = MockBrowshotServer()
+        client = BrowshotClient('key', base=server.base, transport=BrowshotTransport(pool_size=20), metadata_cache=BrowshotMetadataCache())
+        shared = {'instance_id': 12}
+        start = threading.Event()
+        errors = []
+
+        def worker(i):
+            start.wait()
+            try:
+                url = 'http://example.com/%d' % i
+                screenshot = client.screenshot_create(url, shared)
+                self.assertEquals(url, screenshot['url'])
+                self.assertEquals(screenshot['id'], client.screenshot_info(screenshot['id'])['id'])
+                self.assertEquals(url, client.screenshot_info(screenshot['id'], shared)['url'])
+                self.assertEquals(12, client.instance_list()['free'][0]['id'])
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(300)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        client.close()
+        server.stop()
+
+        self.assertEquals([], errors)
+        self.assertEquals({'instance_id': 12}, shared)
+        self.assertEquals(300, len(server.screenshots(0, 1000)))
+
+
+class CommandLine_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = MockBrowshotServer(image_size=1000, processing_time=0.2)
+        self.directory = tempfile.mkdtemp()
+        self.input = os.path.join(self.directory, 'urls.txt')
+        with open(self.input, 'w') as handle:
+            handle.write(''.join('http://example.com/%d\n' % i for i in range(10)))
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def run_main(self, *arguments):
+        output = os.path.join(self.directory, 'output')
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            code = browshot.main(['--base', self.server.base, '-k', 'key', '-o', output, '-p', '2', '-c', '2', '--poll-interval', '0.1'] + list(arguments))
+        finally:
+            sys.stderr = stderr
+        manifest = [simplejson.loads(line) for line in open(os.path.join(output, 'manifest.jsonl'))]
+        return code, output, manifest
+
+    def test_capture(self):
+        code, output, manifest = self.run_main(self.input)
+        self.assertEquals(0, code)
+        self.assertEquals(10, len(manifest))
+        self.assertEquals(['http://example.com/%d' % i for i in range(10)], sorted([entry['url'] for entry in manifest], key=lambda url: int(url.split('/')[-1])))
+        for entry in manifest:
+            self.assertEquals('finished', entry['status'])
+            self.assertEquals(1000, os.path.getsize(entry['file']))
+
+        # Nothing left to do
+        code, output, manifest = self.run_main(self.input)
+        self.assertEquals(10, len(manifest))
+        self.assertEquals(10, len(self.server.screenshots(0, 100)))
+
+    def test_resume(self):
+        output = os.path.join(self.directory, 'output')
+        os.makedirs(output)
+        journal = BrowshotJournal(os.path.join(output, 'journal.sqlite'))
+        client = BrowshotClient('key', base=self.server.base, journal=journal)
+        failed = client.screenshot_create('http://example.com/0', {'instance_id': 12})
+        journal.observe('screenshot/info', dict(failed, status='error'))
+        screenshot = client.screenshot_create('http://example.com/3', {'instance_id': 12})
+        journal.close()
+        client.close()
+
+        code, output, manifest = self.run_main(self.input, '-a', 'instance_id=12')
+        self.assertEquals(9, len(manifest))
+        self.assertEquals(10, len(self.server.screenshots(0, 100)))
+        self.assertEquals([screenshot['id']], [entry['id'] for entry in manifest if entry['url'] == 'http://example.com/3'])
+
+
+class BrowshotMetrics_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = MockBrowshotServer(image_size=10000)
+        self.spans = []
+        self.metrics = BrowshotMetrics(callbacks=[self.spans.append])
+        self.client = BrowshotClient('secret', base=self.server.base, metadata_cache=BrowshotMetadataCache(), metrics=self.metrics)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_requests(self):
+        screenshot = self.client.screenshot_create('http://example.com/', {})
+        self.client.screenshot_info(screenshot['id'], {})
+        self.assertEquals(10000, len(self.client.screenshot_thumbnail(screenshot['id'], {})))
+        self.assertEquals(10000, len(''.join(self.client.screenshot_thumbnail_iter(screenshot['id'], {}))))
+        self.client.instance_list()
+        self.client.instance_list()
+
+        snapshot = self.metrics.snapshot()
+        self.assertEquals({'200': 1}, snapshot['actions']['screenshot/info']['requests'])
+        self.assertEquals(20000, snapshot['actions']['screenshot/thumbnail']['received'])
+        self.assertEquals(2, snapshot['actions']['screenshot/thumbnail']['latency']['total']['count'])
+        self.assertEquals(1, sum(action['connections'] for action in snapshot['actions'].values()))
+        self.assertEquals({'hits': 1, 'misses': 1}, snapshot['caches']['metadata'])
+
+        self.assertEquals(5, len(self.spans))
+        self.assertEquals('GET screenshot/create', self.spans[0]['name'])
+        self.assertEquals('ok', self.spans[0]['status'])
+        for span in self.spans:
+            self.assertEquals(False, 'secret' in span['attributes']['url'])
+            self.assertEquals(True, span['start_time'] <= span['end_time'])
+
+    def test_prometheus(self):
+        self.client.screenshot_info(1, {})
+        self.client.simple('', {})
+        text = self.metrics.prometheus()
+        self.assertEquals(True, 'browshot_requests_total{action="screenshot/info",status="200"} 1\n' in text)
+        self.assertEquals(True, 'browshot_requests_total{action="simple",status="400"} 1\n' in text)
+        self.assertEquals(True, 'browshot_request_duration_seconds_bucket{action="simple",phase="total",le="+Inf"} 1\n' in text)
+        self.assertEquals(True, '# TYPE browshot_request_duration_seconds histogram\n' in text)
+        self.assertEquals('error', self.spans[-1]['status'])
+
+        self.metrics.reset()
+        self.assertEquals({}, self.metrics.snapshot()['actions'])
+
+    def test_redact(self):
+        self.assertEquals('https://api.browshot.com/api/v1/simple?key=***&url=x', _redact('https://api.browshot.com/api/v1/simple?key=secret&url=x'))
+        self.assertEquals('https://api.browshot.com/api/v1/simple?url=x&key=***', _redact('https://api.browshot.com/api/v1/simple?url=x&key=secret'))
+
+
+class BrowshotCoalescer_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = MockBrowshotServer(latency=0.2)
+        self.coalescer = BrowshotCoalescer(window=0.5)
+        self.client = BrowshotClient('key', base=self.server.base, transport=BrowshotTransport(pool_size=20), coalescer=self.coalescer)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def concurrently(self, function, count=20):
+        start = threading.Event()
+        results = []
+
+        def run():
+            start.wait()
+            results.append(function())
+
+        threads = [threading.Thread(target=run) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_in_flight(self):
+        screenshot = self.server.create('http://example.com/', 12)
+        requests = self.server.counters['requests']
+
+        replies = self.concurrently(lambda: self.client.screenshot_info(screenshot['id'], {'details': 1}))
+        self.assertEquals(20, len(replies))
+        self.assertEquals(1, self.server.counters['requests'] - requests)
+
+        # Each caller gets its own copy of the reply
+        replies[0]['status'] = 'changed'
+        self.assertEquals('finished', replies[1]['status'])
+
+        # Not charged: sent again once the first request is complete
+        self.client.screenshot_info(screenshot['id'], {'details': 1})
+        self.assertEquals(2, self.server.counters['requests'] - requests)
+
+        thumbnails = self.concurrently(lambda: self.client.screenshot_thumbnail(screenshot['id'], {}), 5)
+        self.assertEquals([10000] * 5, [len(thumbnail) for thumbnail in thumbnails])
+        self.assertEquals(3, self.server.counters['requests'] - requests)
+
+    def test_charged_window(self):
+        ids = [screenshot['id'] for screenshot in self.concurrently(lambda: self.client.screenshot_create('http://example.com/', {'instance_id': 12, 'size': 'page'}), 10)]
+        self.assertEquals(1, len(set(ids)))
+        self.assertEquals(ids[0], self.client.screenshot_create('http://example.com/', {'size': 'page', 'instance_id': 12})['id'])
+        self.assertEquals(True, ids[0] != self.client.screenshot_create('http://example.org/', {'size': 'page', 'instance_id': 12})['id'])
+
+        time.sleep(0.6)
+        self.assertEquals(True, ids[0] != self.client.screenshot_create('http://example.com/', {'instance_id': 12, 'size': 'page'})['id'])
+        self.assertEquals({'calls': 3, 'shared': 10}, self.coalescer.stats())
+
+    def test_error(self):
+        calls = []
+        def fail():
+            calls.append(1)
+            raise BrowshotError('failed')
+
+        self.assertRaises(BrowshotError, self.coalescer.call, 'screenshot/create', 'key', fail)
+        self.assertRaises(BrowshotError, self.coalescer.call, 'screenshot/create', 'key', fail)
+        self.assertEquals(2, len(calls))
+
+
+class BrowshotThumbnailer_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = MockBrowshotServer()
+        self.client = BrowshotClient('key', base=self.server.base)
+        self.thumbnailer = BrowshotThumbnailer(self.client, processes=2)
+        self.directory = tempfile.mkdtemp()
+        self.screenshot = self.server.create('http://example.com/', 12)
+
+    def tearDown(self):
+        self.thumbnailer.close()
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    @unittest.skipIf(Image is None, 'PIL is not installed')
+    def test_local(self):
+        buffer = StringIO.StringIO()
+        Image.new('RGB', (1024, 768), (255, 0, 0)).save(buffer, 'PNG')
+        self.server.image = buffer.getvalue()
+        requests = self.server.counters['requests']
+
+        files = dict((name, os.path.join(self.directory, name)) for name in ('small.png', 'square.jpg', 'half.png', 'crop.png', 'fit.png'))
+        results = self.thumbnailer.thumbnails(self.screenshot['id'], {
+            files['small.png']:  {'width': 320},
+            files['square.jpg']: {'width': 200, 'height': 200, 'ratio': 'fill'},
+            files['half.png']:   {'scale': 0.5},
+            files['crop.png']:   {'left': 100, 'top': 100, 'right': 300, 'bottom': 200},
+            files['fit.png']:    {'width': 200, 'height': 200},
+        })
+        self.assertEquals(dict((file, file) for file in files.values()), results)
+        self.assertEquals(1, self.server.counters['requests'] - requests)
+
+        self.assertEquals((320, 240), Image.open(files['small.png']).size)
+        self.assertEquals('JPEG', Image.open(files['square.jpg']).format)
+        self.assertEquals((200, 200), Image.open(files['square.jpg']).size)
+        self.assertEquals((512, 384), Image.open(files['half.png']).size)
+        self.assertEquals((200, 100), Image.open(files['crop.png']).size)
+        self.assertEquals((200, 150), Image.open(files['fit.png']).size)
+
+    def test_fallback(self):
+        # The image of the mock server cannot be decoded
+        file = os.path.join(self.directory, 'small.png')
+        requests = self.server.counters['requests']
+
+        self.assertEquals({file: file}, self.thumbnailer.thumbnails(self.screenshot['id'], {file: {'width': 320}}))
+        self.assertEquals(True, os.path.exists(file))
+        self.assertEquals(2 if self.thumbnailer.local else 1, self.server.counters['requests'] - requests)
+
+        results = self.thumbnailer.thumbnails(1000, {file: {'width': 320}})
+        self.assertEquals(True, isinstance(results[file], BrowshotError))
+
+
+class BrowshotHookReceiver_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = MockBrowshotServer(processing_time=60)
+        self.client = BrowshotClient('key', base=self.server.base)
+        self.receiver = BrowshotHookReceiver(self.client, host='127.0.0.1', hook_timeout=30, poll_interval=0.1)
+
+    def tearDown(self):
+        self.receiver.close()
+        self.client.close()
+        self.server.stop()
+
+    def post(self, url, notification):
+        return requests.post(url, data=simplejson.dumps(notification), headers={'Content-Type': 'application/json'})
+
+    def test_notification(self):
+        future = self.receiver.screenshot_create('http://example.com/', {})
+        self.assertEquals(False, future.done())
+        requests = self.server.counters['requests']
+
+        # Not done yet
+        url = self.receiver.hook_url('screenshot')
+        self.assertEquals(200, self.post(url, {'id': 1, 'status': 'processing'}).status_code)
+        self.assertEquals(False, future.done())
+
+        self.assertEquals(200, self.post(url, {'id': 1, 'status': 'finished', 'width': 1024}).status_code)
+        self.assertEquals(1024, future.result(5)['width'])
+        self.assertEquals(0, self.receiver.pending())
+        self.assertEquals(requests, self.server.counters['requests'])
+
+    def test_invalid(self):
+        future = self.receiver.watch('screenshot', 1)
+        self.assertEquals(403, self.post(self.receiver.hook_url('screenshot').replace(self.receiver.token, 'x' * 40), {'id': 1, 'status': 'finished'}).status_code)
+        self.assertEquals(404, self.post(self.receiver.hook_url('screenshot') + 's', {'id': 1, 'status': 'finished'}).status_code)
+        self.assertEquals(400, self.post(self.receiver.hook_url('screenshot'), {'status': 'finished'}).status_code)
+        self.assertEquals(400, requests.post(self.receiver.hook_url('screenshot'), data='{', headers={'Content-Type': 'application/json'}).status_code)
+        self.assertEquals(200, self.post(self.receiver.hook_url('batch'), {'id': 1, 'status': 'finished'}).status_code)
+        self.assertEquals(False, future.done())
+
+        # Form and query string
+        self.assertEquals(200, requests.post(self.receiver.hook_url('screenshot') + '?id=1', data={'status': 'error'}).status_code)
+        self.assertEquals('error', future.result(5)['status'])
+
+    def test_fallback(self):
+        self.server.processing_time = 0.3
+        self.receiver.hook_timeout = 0
+
+        future = self.receiver.watch('screenshot', self.server.create('http://example.org/', 12)['id'], timeout=5)
+        self.assertEquals('finished', future.result(5)['status'])
+
+        self.server.processing_time = 60
+        future = self.receiver.watch('screenshot', self.server.create('http://example.net/', 12)['id'], timeout=0.3)
+        self.assertRaises(BrowshotError, future.result, 5)
+
+
+class BrowshotJournal_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = MockBrowshotServer()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal.sqlite')
+        self.journal = BrowshotJournal(self.path, sync_interval=60)
+        self.client = BrowshotClient('key', base=self.server.base, journal=self.journal)
+
+    def tearDown(self):
+        self.journal.close()
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_resume(self):
+        screenshot = self.client.screenshot_create('http://example.com/', {'instance_id': 12, 'size': 'page'})
+        self.assertEquals(screenshot, self.client.screenshot_create('http://example.com/', {'size': 'page', 'instance_id': 12}))
+        self.assertEquals(True, screenshot['id'] != self.client.screenshot_create('http://example.com/', {'instance_id': 12})['id'])
+        self.client.screenshot_info(screenshot['id'], {})
+        self.journal.close()
+
+        # Restarted process
+        journal = BrowshotJournal(self.path)
+        client = BrowshotClient('key', base=self.server.base, journal=journal, typed=True)
+        self.assertEquals(screenshot['id'], client.screenshot_create('http://example.com/', {'instance_id': 12, 'size': 'page'}).id)
+        self.assertEquals(2, len(self.server.screenshots(0, 100)))
+
+        self.assertEquals('finished', journal.job('screenshot', screenshot['id'])['status'])
+        self.assertEquals(2, len(journal.unfinished()))
+        file = client.screenshot_thumbnail_file(screenshot['id'], os.path.join(self.directory, 'image.png'), {})
+        self.assertEquals(file, journal.job('screenshot', screenshot['id'])['file'])
+        self.assertEquals(1, len(journal.unfinished()))
+        self.assertEquals(2, len(journal.jobs(url='http://example.com/')))
+        journal.close()
+
+    def test_multiple_and_batch(self):
+        screenshots = self.client.screenshot_multiple({'urls': ['http://example.com/', 'http://example.org/'], 'instances': [12]})
+        self.assertEquals(screenshots, self.client.screenshot_multiple({'urls': ['http://example.com/', 'http://example.org/'], 'instances': [12]}))
+        self.client.screenshot_list({})
+        self.assertEquals(['finished', 'finished'], [job['status'] for job in self.journal.jobs(status='finished')])
+        self.assertEquals(['http://example.org/'], [job['url'] for job in self.journal.jobs(url='http://example.org/')])
+
+        file = os.path.join(self.directory, 'urls.txt')
+        with open(file, 'w') as handle:
+            handle.write('http://example.com/\n')
+        batch = self.client.batch_create(file, {})
+        self.assertEquals(batch, self.client.batch_create(file, {}))
+        self.assertEquals(1, len(self.server.uploads))
+        self.assertEquals([batch['id']], [job['id'] for job in self.journal.jobs('batch')])
+
+    def test_batched_commits(self):
+        self.client.screenshot_create('http://example.com/', {})
+        other = BrowshotJournal(self.path)
+        self.assertEquals(0, len(other.jobs()))
+
+        self.journal.flush()
+        self.assertEquals(1, len(other.jobs()))
+        other.close()
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) Julien Sobrier
+#
+# This file is part of printio released under MIT license.
+# See the LICENSE for more information.
+"""
+
+Local stand-in for the Browshot API, used by the tests and the benchmarks.
+
+"""
+
+import cgi
+import zlib
+import time
+import zipfile
+import urlparse
+import threading
+import StringIO
+import SocketServer
+import BaseHTTPServer
+
+import simplejson
+
+
+class MockBrowshotHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each reply in as few packets as possible, like a real server
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request({})
+
+    def do_POST(self):
+        if self.headers.get('Transfer-Encoding', '') == 'chunked':
+            body = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                body.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = ''.join(body)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if self.headers.get('Content-Encoding', '') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+        self.server.count('uploaded', len(body))
+        form = cgi.FieldStorage(fp=StringIO.StringIO(body), headers={'content-type': self.headers['Content-Type'], 'content-length': str(len(body))},
+                                environ={'REQUEST_METHOD': 'POST'})
+        self.handle_request(form)
+
+    def handle_request(self, form):
+        server = self.server
+        server.count('requests')
+        if server.latency > 0:
+            time.sleep(server.latency)
+
+        url = urlparse.urlparse(self.path)
+        action = url.path.split('/api/v1/', 1)[-1]
+        query = urlparse.parse_qs(url.query)
+        for key in form.keys():
+            query.setdefault(key, []).extend(form.getlist(key))
+        parameters = dict((key, values[-1]) for key, values in query.items())
+
+        if action == 'simple':
+            if parameters.get('url', '') == '':
+                return self.reply('', 400, 'image/png')
+            return self.reply(server.image, content_type='image/png')
+
+        if action == 'screenshot/thumbnail':
+            if server.screenshot(parameters.get('id')) is None:
+                return self.reply('', 404, 'image/png')
+            return self.reply(server.image, content_type='image/png')
+
+        if action.startswith('batch/') and action.endswith('.zip'):
+            range = self.headers.get('Range', '')
+            if range.startswith('bytes=') and range.endswith('-'):
+                start = int(range[len('bytes='):-1])
+                if start >= len(server.archive):
+                    return self.reply('', 416, 'application/zip')
+                return self.reply(server.archive[start:], 206, 'application/zip')
+            return self.reply(server.archive, content_type='application/zip')
+
+        if action == 'screenshot/create':
+            if parameters.get('url', '') in ('', '-'):
+                return self.json({'error': 'Missing or invalid URL', 'status': 'error'})
+            return self.json(server.create(parameters['url'], parameters.get('instance_id', 12)))
+
+        if action == 'screenshot/multiple':
+            return self.json(dict((screenshot['id'], screenshot) for screenshot in
+                [server.create(url, instance) for url in query.get('url', []) for instance in query.get('instance_id', [12])]))
+
+        if action == 'screenshot/info':
+            screenshot = server.screenshot(parameters.get('id'))
+            if screenshot is None:
+                return self.json({'error': 'Invalid screenshot ID', 'status': 'error'})
+            return self.json(screenshot)
+
+        if action in ('screenshot/list', 'screenshot/search'):
+            limit = int(parameters.get('limit', 100))
+            offset = int(parameters.get('offset', 0))
+            return self.json(dict((screenshot['id'], screenshot) for screenshot in server.screenshots(offset, limit)))
+
+        if action == 'batch/create':
+            if not 'file' in form:
+                return self.json({'error': 'Missing file', 'status': 'error'})
+            urls = [line for line in form['file'].value.splitlines() if line.strip() != '']
+            self.server.uploads.append(urls)
+            return self.json(server.batch(len(urls)))
+
+        if action == 'batch/info':
+            batch = server.batches.get(parameters.get('id'))
+            if batch is None:
+                return self.json({'error': 'Invalid batch ID', 'status': 'error'})
+            return self.json(batch)
+
+        if action == 'crawl/create':
+            screenshots = [server.create(parameters.get('url', ''), 12) for i in range(int(parameters.get('max', 5)))]
+            return self.json(server.crawl(parameters.get('domain', ''), screenshots))
+
+        if action == 'crawl/info':
+            crawl = server.crawls.get(parameters.get('id'))
+            if crawl is None:
+                return self.json({'error': 'Invalid crawl ID', 'status': 'error'})
+            return self.json(dict(crawl, screenshots=[server.screenshot(id) for id in crawl['screenshots']]))
+
+        if action == 'instance/list':
+            return self.json(server.instances)
+
+        if action == 'browser/list':
+            return self.json({'1': {'name': 'Firefox', 'mobile': 0, 'javascript': 1, 'flash': 0}})
+
+        if action == 'account/info':
+            return self.json({'balance': server.balance, 'active': 1, 'free_screenshots_left': 100})
+
+        return self.json({'error': 'Unknown action', 'status': 'error'}, 404)
+
+    def json(self, data, code=200):
+        self.reply(simplejson.dumps(data), code, 'application/json')
+
+    def reply(self, content, code=200, content_type='text/plain'):
+        self.server.count('bytes', len(content))
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class MockBrowshotServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, latency=0, image_size=10000, processing_time=0, port=0):
+        """ Start a local server answering like the Browshot API on a random port. Use server.base as the base of BrowshotClient.
+
+        Arguments:
+            latency: seconds to wait before each reply
+            image_size: size in bytes of the images returned by simple and screenshot/thumbnail
+            processing_time: seconds before a screenshot is finished. Screenshots are in_queue, then processing for the second half of this time.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), MockBrowshotHandler)
+
+        self.latency = latency
+        self.processing_time = processing_time
+        self.image = '\x89PNG\r\n\x1a\n' + 'x' * max(image_size - 8, 0)
+        self.balance = 1000
+        self.instances = {
+            'free': [{'id': 12, 'width': 1024, 'height': 768, 'load': 1, 'type': 'public', 'screenshot_cost': 0,
+                      'browser': {'id': 1, 'name': 'Firefox', 'javascript': 1, 'flash': 0, 'mobile': 0}}],
+            'shared': [], 'private': [],
+        }
+        self.counters = {'connections': 0, 'requests': 0, 'bytes': 0, 'uploaded': 0}
+        self.batches = {}
+        self.crawls = {}
+        self.uploads = []
+
+        self._screenshots = {}
+        self._lock = threading.Lock()
+
+        buffer = StringIO.StringIO()
+        archive = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED)
+        for i in range(1, 4):
+            archive.writestr('%d.png' % i, self.image)
+        archive.close()
+        self.archive = buffer.getvalue()
+
+        self.base = 'http://127.0.0.1:%d/api/v1/' % self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def create(self, url, instance_id):
+        with self._lock:
+            id = len(self._screenshots) + 1
+            self._screenshots[id] = {'id': id, 'url': url, 'instance_id': int(instance_id), 'created': time.time(), 'priority': 1}
+        return self.screenshot(id)
+
+    def screenshot(self, id):
+        try:
+            with self._lock:
+                screenshot = dict(self._screenshots[int(id)])
+        except (KeyError, ValueError, TypeError):
+            return None
+
+        age = time.time() - screenshot.pop('created')
+        if age >= self.processing_time:
+            screenshot.update({'status': 'finished', 'screenshot_url': self.base + 'screenshot/thumbnail?id=%d' % screenshot['id'],
+                               'final_url': screenshot['url'], 'width': 1024, 'height': 768, 'size': 'screen', 'scale': 1, 'cost': 0})
+        elif age >= self.processing_time / 2.0:
+            screenshot['status'] = 'processing'
+        else:
+            screenshot['status'] = 'in_queue'
+        return screenshot
+
+    def screenshots(self, offset, limit):
+        with self._lock:
+            ids = sorted(self._screenshots.keys(), reverse=True)[offset:offset + limit]
+        return [self.screenshot(id) for id in ids]
+
+    def batch(self, count):
+        with self._lock:
+            id = str(len(self.batches) + 1)
+            self.batches[id] = {'id': int(id), 'status': 'finished', 'count': count, 'processed': count, 'failed': 0,
+                                'urls': [self.base + 'batch/%s.zip' % id]}
+            return dict(self.batches[id])
+
+    def crawl(self, domain, screenshots):
+        with self._lock:
+            id = str(len(self.crawls) + 1)
+            self.crawls[id] = {'id': int(id), 'domain': domain, 'status': 'finished', 'count': len(screenshots),
+                               'screenshots': [screenshot['id'] for screenshot in screenshots]}
+        return dict(self.crawls[id], screenshots=screenshots)